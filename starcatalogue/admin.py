@@ -17,15 +17,16 @@ class DataExportAdmin(admin.ModelAdmin):
         "id",
         "created",
         "data_version",
+        "export_format",
         "export_status",
         "in_data_archive",
     )
-    list_filter = ("in_data_archive", "export_status", "data_version")
+    list_filter = ("in_data_archive", "export_format", "export_status", "data_version")
     fields = (
         "in_data_archive",
         "doi",
         "data_version",
-        "export_file",
+        ("export_format", "export_file"),
         ("min_period", "max_period"),
         ("min_magnitude", "max_magnitude"),
         ("min_amplitude", "max_amplitude"),
@@ -34,7 +35,7 @@ class DataExportAdmin(admin.ModelAdmin):
         ("type_pulsator", "type_rotator", "type_ew", "type_eaeb", "type_unknown"),
         ("search", "search_radius"),
     )
-    readonly_fields = fields[2:4] + tuple(f for f in chain.from_iterable(fields[4:]))
+    readonly_fields = fields[2:3] + tuple(f for f in chain.from_iterable(fields[3:]))
     ordering = ("-created",)
 
 
@@ -183,16 +184,25 @@ class DataReleaseAdmin(admin.ModelAdmin):
     list_display = (
         "version",
         "generate_export",
+        "incremental",
         "active",
         "created",
+        "progress",
         "aggregation_finished",
         "pending_stars",
     )
-    readonly_fields = ("aggregation_finished", "pending_stars")
+    readonly_fields = (
+        "progress",
+        "aggregation_finished",
+        "pending_stars",
+        "base_release",
+        "last_classification_id",
+    )
     fields = (
         ("version", "generate_export"),
+        ("incremental", "base_release", "last_classification_id"),
         ("active", "active_at"),
-        ("aggregation_finished", "pending_stars"),
+        ("progress", "aggregation_finished", "pending_stars"),
     )
 
 
@@ -0,0 +1,34 @@
+import hashlib
+import uuid
+
+from django.core.cache import caches
+
+
+RESULTS_CACHE_ALIAS = "results"
+RESULTS_CACHE_GENERATION_KEY = "starcatalogue:results:generation"
+
+
+def get_results_cache():
+    return caches[RESULTS_CACHE_ALIAS]
+
+
+def results_cache_key(*parts):
+    """
+    Returns a cache key for search results, given the normalised search parameters.
+
+    The current cache generation is part of every key, so invalidating the cache
+    just means starting a new generation. Old entries are never read again and
+    expire on their own.
+    """
+    generation = get_results_cache().get_or_set(
+        RESULTS_CACHE_GENERATION_KEY, uuid.uuid4().hex, timeout=None
+    )
+    digest = hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+    return f"starcatalogue:results:{generation}:{digest}"
+
+
+def invalidate_results_cache():
+    get_results_cache().set(
+        RESULTS_CACHE_GENERATION_KEY, uuid.uuid4().hex, timeout=None
+    )
+
@@ -0,0 +1,184 @@
+import datetime
+import os
+import shutil
+
+from pathlib import Path
+
+import numpy
+import pandas
+import ujson as json
+
+
+CLASSIFICATION_STORE_VERSION = 1
+
+CATEGORICAL_COLUMNS = ["classification", "period_certainty", "user_name"]
+STORE_COLUMNS = ["classification_id", "subject_id"] + CATEGORICAL_COLUMNS
+# The columns needed to aggregate a data release
+AGGREGATION_COLUMNS = [
+    "classification_id",
+    "subject_id",
+    "classification",
+    "period_certainty",
+]
+
+COLUMN_DTYPES = {
+    "classification_id": numpy.int64,
+    "subject_id": numpy.int32,
+    "classification": numpy.int16,
+    "period_certainty": numpy.int16,
+    "user_name": numpy.int32,
+}
+
+
+class ClassificationStore(object):
+    """
+    An on-disk cache of the classifications read from Zooniverse exports.
+
+    Each export appends a partition holding only the classifications which are
+    newer than those already stored, keyed by the export's date. A partition is a
+    directory with one .npy file per column, and categorical columns are stored as
+    codes into categories shared by every partition. Columns are memory mapped, so
+    loading only reads the columns which are asked for.
+
+    The partitions and categories are listed in store.json. A store written with a
+    different CLASSIFICATION_STORE_VERSION is discarded.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.metadata = self.read_metadata()
+
+    @property
+    def metadata_path(self):
+        return self.root / "store.json"
+
+    @property
+    def partitions_path(self):
+        return self.root / "partitions"
+
+    def read_metadata(self):
+        try:
+            with open(self.metadata_path) as metadata_f:
+                metadata = json.load(metadata_f)
+        except FileNotFoundError:
+            metadata = None
+        if metadata is None or metadata["version"] != CLASSIFICATION_STORE_VERSION:
+            metadata = {
+                "version": CLASSIFICATION_STORE_VERSION,
+                "partitions": [],
+                "categories": {column: [] for column in CATEGORICAL_COLUMNS},
+            }
+        return metadata
+
+    def write_metadata(self):
+        # Replaced in one step, so a failed append leaves the store as it was
+        temp_path = self.metadata_path.with_suffix(".tmp")
+        with open(temp_path, "w") as metadata_f:
+            json.dump(self.metadata, metadata_f)
+        os.replace(temp_path, self.metadata_path)
+
+    @property
+    def partitions(self):
+        return self.metadata["partitions"]
+
+    @property
+    def latest_export_date(self):
+        if not self.partitions:
+            return None
+        return datetime.datetime.fromisoformat(self.partitions[-1]["export_date"])
+
+    @property
+    def last_classification_id(self):
+        if not self.partitions:
+            return None
+        return max(partition["last_classification_id"] for partition in self.partitions)
+
+    def append(self, classifications, export_date):
+        """
+        Stores classifications (as returned by read_classification_export) as a new
+        partition for the export from export_date.
+        """
+        if not self.partitions and self.partitions_path.exists():
+            # Left over from a discarded version of the store
+            shutil.rmtree(self.partitions_path)
+        name = export_date.strftime("%Y%m%dT%H%M%S")
+        partition_path = self.partitions_path / name
+        partition_path.mkdir(parents=True, exist_ok=True)
+
+        for column in STORE_COLUMNS:
+            values = classifications[column]
+            if column in CATEGORICAL_COLUMNS:
+                categories = self.metadata["categories"][column]
+                values = pandas.Categorical(values)
+                known = set(categories)
+                categories.extend(
+                    category for category in values.categories if category not in known
+                )
+                codes = {category: code for code, category in enumerate(categories)}
+                category_codes = numpy.array(
+                    [codes[category] for category in values.categories],
+                    dtype=COLUMN_DTYPES[column],
+                )
+                values = category_codes[values.codes]
+            numpy.save(
+                partition_path / f"{column}.npy",
+                numpy.asarray(values, dtype=COLUMN_DTYPES[column]),
+                allow_pickle=False,
+            )
+
+        self.partitions.append(
+            {
+                "name": name,
+                "export_date": export_date.isoformat(),
+                "rows": len(classifications),
+                "last_classification_id": (
+                    int(classifications["classification_id"].max())
+                    if len(classifications)
+                    else self.last_classification_id or 0
+                ),
+            }
+        )
+        self.write_metadata()
+
+    def read_column(self, partition, column):
+        return numpy.load(
+            self.partitions_path / partition["name"] / f"{column}.npy", mmap_mode="r"
+        )
+
+    def load(self, columns=STORE_COLUMNS, export_date=None):
+        """
+        Returns the stored classifications as a frame with the given columns, from
+        the partitions up to and including export_date if it's given.
+
+        Classifications of a subject by a user who had already classified it in an
+        earlier partition are dropped.
+        """
+        partitions = [
+            partition
+            for partition in self.partitions
+            if export_date is None
+            or datetime.datetime.fromisoformat(partition["export_date"])
+            <= export_date
+        ]
+
+        def read(column):
+            return numpy.concatenate(
+                [self.read_column(partition, column) for partition in partitions]
+                or [numpy.empty(0, dtype=COLUMN_DTYPES[column])]
+            )
+
+        keep = slice(None)
+        if len(partitions) > 1:
+            keys = (read("user_name").astype(numpy.int64) << 32) | read("subject_id")
+            _, first = numpy.unique(keys, return_index=True)
+            keep = numpy.sort(first)
+
+        frame = {}
+        for column in columns:
+            values = read(column)[keep]
+            if column in CATEGORICAL_COLUMNS:
+                values = pandas.Categorical.from_codes(
+                    values, categories=self.metadata["categories"][column]
+                )
+            frame[column] = values
+        return pandas.DataFrame(frame)
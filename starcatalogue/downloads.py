@@ -0,0 +1,211 @@
+import concurrent.futures
+import functools
+import http.client
+import logging
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class DownloadError(Exception):
+    """
+    The server refused the request, so retrying won't help.
+    """
+
+
+class FITSDownloader(object):
+    """
+    Fetches FITS files from the lcextract endpoint with a pool of threads.
+
+    Each thread keeps its connection to the server open between requests, and no
+    more than concurrency requests are made to one host at a time. Failed requests
+    are retried with exponential backoff, unless the server returned a 4xx error.
+    Redirects are followed, over the thread's connection if they stay on the same
+    host.
+    The threads, and so their connections, are kept between calls to download until
+    the downloader is closed.
+    """
+
+    def __init__(
+        self,
+        url=None,
+        concurrency=None,
+        retries=None,
+        backoff=1.0,
+        timeout=30,
+    ):
+        self.url = urllib.parse.urlsplit(url or settings.FITS_DOWNLOAD_URL)
+        self.concurrency = concurrency or settings.FITS_DOWNLOAD_CONCURRENCY
+        self.retries = settings.FITS_DOWNLOAD_RETRIES if retries is None else retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._connections = threading.local()
+        self._open_connections = []
+        self._open_connections_lock = threading.Lock()
+        self._host_slots = threading.BoundedSemaphore(self.concurrency)
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open_connection(self, url):
+        connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        return connection_class(url.netloc, timeout=self.timeout)
+
+    def get_connection(self):
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            connection = self.open_connection(self.url)
+            self._connections.connection = connection
+            with self._open_connections_lock:
+                self._open_connections.append(connection)
+        return connection
+
+    def close_connection(self):
+        connection = getattr(self._connections, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._connections.connection = None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+        with self._open_connections_lock:
+            for connection in self._open_connections:
+                connection.close()
+            self._open_connections = []
+
+    def get_path(self, superwasp_id):
+        encoded_params = urllib.parse.urlencode(
+            {"objid": superwasp_id.replace("1SWASP", "1SWASP ")},
+            quote_via=urllib.parse.quote,
+        )
+        return f"{self.url.path}?{encoded_params}"
+
+    def fetch(self, superwasp_id, fits_file):
+        """
+        Streams the FITS file for superwasp_id into the open file fits_file.
+
+        Raises DownloadError if the server refuses the request. Other errors are
+        raised once the retries have been used up.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with self._host_slots:
+                    return self._fetch(superwasp_id, fits_file)
+            except DownloadError:
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                self.close_connection()
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+                logger.info(
+                    f"Retrying download of {superwasp_id} in {delay}s after: {e}"
+                )
+                time.sleep(delay)
+
+    def _fetch(self, superwasp_id, fits_file):
+        fits_file.seek(0)
+        fits_file.truncate()
+        location = urllib.parse.urljoin(self.url.geturl(), self.get_path(superwasp_id))
+        for _ in range(MAX_REDIRECTS + 1):
+            url = urllib.parse.urlsplit(location)
+            same_host = (url.scheme, url.netloc) == (self.url.scheme, self.url.netloc)
+            connection = (
+                self.get_connection() if same_host else self.open_connection(url)
+            )
+            try:
+                connection.request("GET", url._replace(scheme="", netloc="").geturl())
+                response = connection.getresponse()
+                # The body must be read in full before the connection can be reused
+                if response.status in REDIRECT_STATUSES:
+                    response.read()
+                    if not response.getheader("Location"):
+                        raise http.client.HTTPException(
+                            f"{superwasp_id}: HTTP {response.status} without Location"
+                        )
+                    location = urllib.parse.urljoin(
+                        location, response.getheader("Location")
+                    )
+                    continue
+                if response.status != 200:
+                    response.read()
+                    if 400 <= response.status < 500:
+                        raise DownloadError(f"{superwasp_id}: HTTP {response.status}")
+                    raise http.client.HTTPException(
+                        f"{superwasp_id}: HTTP {response.status}"
+                    )
+                while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                    fits_file.write(chunk)
+                fits_file.seek(0)
+                return fits_file
+            finally:
+                if not same_host:
+                    connection.close()
+        raise http.client.HTTPException(f"{superwasp_id}: too many redirects")
+
+    def download(self, superwasp_ids):
+        """
+        Fetches many FITS files concurrently. Yields (superwasp_id, file, error) as
+        each one finishes, where file is a temporary file holding the FITS data (or
+        None if error is set). Each file is closed once the caller moves on.
+        """
+
+        def fetch_to_tempfile(superwasp_id):
+            fits_file = tempfile.TemporaryFile()
+            try:
+                return self.fetch(superwasp_id, fits_file)
+            except:
+                fits_file.close()
+                raise
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency
+            )
+        futures = {
+            self._executor.submit(fetch_to_tempfile, superwasp_id): superwasp_id
+            for superwasp_id in superwasp_ids
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                superwasp_id = futures[future]
+                try:
+                    fits_file = future.result()
+                except (DownloadError, OSError, http.client.HTTPException) as e:
+                    yield superwasp_id, None, e
+                    continue
+                with fits_file:
+                    yield superwasp_id, fits_file, None
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+@functools.cache
+def get_fits_downloader():
+    """
+    Returns this process's downloader, so that single downloads reuse its
+    connections and share its limit on requests to the server.
+    """
+    return FITSDownloader()
+
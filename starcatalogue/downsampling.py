@@ -0,0 +1,62 @@
+import numpy
+
+
+# Number of buckets in each downsampled level. Each bucket keeps two points.
+DOWNSAMPLED_LEVEL_BUCKETS = (1024, 4096, 16384)
+
+TIME_DTYPE = numpy.dtype("<f8")
+FLUX_DTYPE = numpy.dtype("<f4")
+
+
+def minmax_downsample(x, y, buckets):
+    """
+    Splits the points (ordered by x) into equal sized buckets and returns the indices
+    of the minimum and maximum y in each, in their original order.
+    """
+    n = len(y)
+    boundaries = numpy.linspace(0, n, buckets + 1).astype(numpy.intp)
+    segments = numpy.repeat(numpy.arange(buckets), numpy.diff(boundaries))
+    order = numpy.lexsort((y, segments))
+    non_empty = boundaries[1:] > boundaries[:-1]
+    return numpy.union1d(
+        order[boundaries[:-1][non_empty]], order[boundaries[1:][non_empty] - 1]
+    )
+
+
+def encode_levels(x, y, level_buckets=DOWNSAMPLED_LEVEL_BUCKETS):
+    """
+    Encodes a lightcurve for the browser as downsampled levels followed by the full
+    data, smallest first. Each level is little-endian float64 times followed by
+    float32 fluxes, padded to a multiple of 8 bytes.
+
+    Times stay float64 because float32 can't resolve individual observations at
+    Julian dates. Returns the encoded bytes and a list describing each level.
+    """
+    order = numpy.argsort(x, kind="stable")
+    x = numpy.asarray(x)[order]
+    y = numpy.asarray(y)[order]
+
+    levels = [
+        (x[indices], y[indices])
+        for indices in (
+            minmax_downsample(x, y, buckets)
+            for buckets in level_buckets
+            if len(x) > buckets * 2
+        )
+    ]
+    levels.append((x, y))
+
+    chunks = []
+    descriptions = []
+    offset = 0
+    for level_x, level_y in levels:
+        chunk = (
+            level_x.astype(TIME_DTYPE).tobytes() + level_y.astype(FLUX_DTYPE).tobytes()
+        )
+        chunk += b"\0" * (-len(chunk) % 8)
+        descriptions.append(
+            {"points": len(level_x), "offset": offset, "length": len(chunk)}
+        )
+        chunks.append(chunk)
+        offset += len(chunk)
+    return b"".join(chunks), descriptions
@@ -2,9 +2,21 @@
 # params, etc. that define the export parameters. This makes
 # it easier to add new fields, since they're all in one place.
 
+import csv
+import itertools
+import shutil
+import tempfile
 import uuid
 
+import numpy
+import pandas
+
+import astropy.io.fits as fits
+from astropy import units
+from astropy.coordinates import Angle
+
 from django.conf import settings
+from django.core.files.storage import default_storage
 from django.db import models
 from django.http import HttpResponseRedirect, HttpResponseBadRequest, Http404
 from django.template import RequestContext
@@ -13,7 +25,7 @@ from django.views import View
 
 from humanize import naturalsize
 
-from .models import DataRelease, export_upload_to
+from .models import AggregatedClassification, DataRelease, Star, export_upload_to
 
 
 # Params where the model field doesn't use choices
@@ -42,6 +54,8 @@ DISPLAYABLE_EXPORT_PARAMS = (
     "type_unknown",
 )
 EXPORT_PARAMS = BASIC_EXPORT_PARAMS + DISPLAYABLE_EXPORT_PARAMS
+# Number of records fetched from the database at a time while generating an export
+EXPORT_CHUNK_SIZE = 2000
 
 
 def gen_export_params_dict(obj, displayable=False):
@@ -83,7 +97,23 @@ class DataExport(models.Model):
     ]
     CHECKBOX_CHOICES_DICT = dict([(v, k) for (k, v) in CHECKBOX_CHOICES])
 
+    FORMAT_CSV = 0
+    FORMAT_FITS = 1
+    FORMAT_CHOICES = (
+        (FORMAT_CSV, "CSV"),
+        (FORMAT_FITS, "FITS"),
+    )
+    FORMAT_CHOICES_DICT = dict([(v.lower(), k) for (k, v) in FORMAT_CHOICES])
+
     EXPORT_FILE_NAME = "superwasp-vespa-export.zip"
+    EXPORT_FILE_NAMES = {
+        FORMAT_CSV: EXPORT_FILE_NAME,
+        FORMAT_FITS: "superwasp-vespa-export-fits.zip",
+    }
+    EXPORT_DATA_FILE_NAMES = {
+        FORMAT_CSV: "export.csv",
+        FORMAT_FITS: "export.fits",
+    }
 
     STATUS_PENDING = 0
     STATUS_RUNNING = 1
@@ -126,6 +156,7 @@ class DataExport(models.Model):
     data_release = models.ForeignKey(DataRelease, on_delete=models.CASCADE, null=True)
 
     celery_task_id = models.UUIDField(null=True)
+    export_format = models.IntegerField(choices=FORMAT_CHOICES, default=FORMAT_CSV)
     export_status = models.IntegerField(choices=STATUS_CHOICES, default=STATUS_PENDING)
     export_file = models.FileField(
         upload_to=export_upload_to,
@@ -149,6 +180,14 @@ class DataExport(models.Model):
             params=self.queryset_params, data_release=self.data_release
         )
 
+    @property
+    def export_file_name(self):
+        return self.EXPORT_FILE_NAMES[self.export_format]
+
+    @property
+    def export_data_file_name(self):
+        return self.EXPORT_DATA_FILE_NAMES[self.export_format]
+
     @property
     def export_file_naturalsize(self):
         return naturalsize(self.export_file.size)
@@ -162,6 +201,7 @@ def gen_export_params_yaml_dict(export, total_records):
     params = {
         "data_version": export.data_version,
         "object_count": total_records,
+        "export_format": export.get_export_format_display(),
     }
     params.update(gen_export_params_dict(export))
     return params
@@ -191,39 +231,180 @@ EXPORT_DATA_DESCRIPTION = {
 }
 
 
-def gen_export_record_dict(record):
-    out = {
-        "SuperWASP ID": record.lightcurve.star.superwasp_id,
-        "Period Length": record.lightcurve.period_length,
-        "RA": record.lightcurve.star.ra,
-        "Dec": record.lightcurve.star.dec,
-        "Maximum magnitude": record.lightcurve.star.max_magnitude,
-        "Minimum magnitude": record.lightcurve.star.min_magnitude,
-        "Mean magnitude": record.lightcurve.star.mean_magnitude,
-        "Amplitude": record.lightcurve.star.amplitude,
-        "Classification": record.get_classification_display(),
-        "Classification count": record.classification_count,
-        "Folding flag": record.get_period_uncertainty_display(),
-        "Sigma": record.lightcurve.sigma,
-        "Chi squared": record.lightcurve.chi_squared,
-        "FITS URL": "",
-        "JSON URL": "",
-        "Unfolded plot URL": "",
-        "Folded plot URL": "",
-    }
-    if record.lightcurve.star.fits_file:
-        out.update(
-            {
-                "FITS URL": f"https://{settings.ALLOWED_HOSTS[0]}{record.lightcurve.star.fits_file.url}",
-                "JSON URL": f"https://{settings.ALLOWED_HOSTS[0]}{record.lightcurve.star.json_file.url}",
-                "Unfolded plot URL": f"https://{settings.ALLOWED_HOSTS[0]}{record.lightcurve.star.image_file.url}",
-                "Folded plot URL": f"https://{settings.ALLOWED_HOSTS[0]}{record.lightcurve.image_file.url}",
-            }
+# Columns fetched for each record in a single query of CatalogueEntries, with file
+# names from FoldedLightcurve and Star
+EXPORT_QUERYSET_FIELDS = (
+    "superwasp_id",
+    "period_length",
+    "max_magnitude",
+    "min_magnitude",
+    "mean_magnitude",
+    "amplitude",
+    "classification",
+    "classification_count",
+    "period_uncertainty",
+    "sigma",
+    "chi_squared",
+    "star__fits_file",
+    "star__json_file",
+    "star__image_file",
+    "lightcurve__image_file",
+)
+
+FITS_BLOCK_SIZE = 2880
+# Column types used for FITS exports. RA and Dec are stored as numbers (in hours and
+# degrees) rather than sexagesimal strings.
+EXPORT_FITS_FORMATS = {
+    "SuperWASP ID": "26A",
+    "Period Length": "D",
+    "RA": "D",
+    "Dec": "D",
+    "Maximum magnitude": "D",
+    "Minimum magnitude": "D",
+    "Mean magnitude": "D",
+    "Amplitude": "D",
+    "Classification": "8A",
+    "Classification count": "J",
+    "Folding flag": "9A",
+    "Sigma": "D",
+    "Chi squared": "D",
+    "FITS URL": "256A",
+    "JSON URL": "256A",
+    "Unfolded plot URL": "256A",
+    "Folded plot URL": "256A",
+}
+
+EXPORT_URL_FIELDS = {
+    "FITS URL": "star__fits_file",
+    "JSON URL": "star__json_file",
+    "Unfolded plot URL": "star__image_file",
+    "Folded plot URL": "lightcurve__image_file",
+}
+
+
+def gen_export_records(queryset, chunk_size=EXPORT_CHUNK_SIZE, sexagesimal=True):
+    """
+    Given a queryset of CatalogueEntries, yields the export records as
+    DataFrames of up to chunk_size rows, with columns matching
+    EXPORT_DATA_DESCRIPTION.
+
+    Only the stored values are used, so stars with outdated stats are exported as
+    they are rather than being recalculated.
+
+    Arguments:
+        - sexagesimal: Bool. If True, RA and Dec are formatted as sexagesimal
+          strings. Otherwise they are given as floats in hours and degrees.
+    """
+    rows = queryset.values_list(*EXPORT_QUERYSET_FIELDS).iterator(
+        chunk_size=chunk_size
+    )
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield gen_export_records_frame(
+            pandas.DataFrame.from_records(chunk, columns=EXPORT_QUERYSET_FIELDS),
+            sexagesimal=sexagesimal,
         )
 
+
+def gen_export_records_frame(values, sexagesimal=True):
+    ra, dec = Star.parse_superwasp_ids(values["superwasp_id"])
+    if sexagesimal:
+        ra = Angle(ra, units.deg).to_string(units.hour)
+        dec = Angle(dec, units.deg).to_string(units.deg)
+    else:
+        ra = ra / 15
+    out = pandas.DataFrame(
+        {
+            "SuperWASP ID": values["superwasp_id"],
+            "Period Length": values["period_length"],
+            "RA": ra,
+            "Dec": dec,
+            "Maximum magnitude": values["max_magnitude"],
+            "Minimum magnitude": values["min_magnitude"],
+            "Mean magnitude": values["mean_magnitude"],
+            "Amplitude": values["amplitude"],
+            "Classification": values["classification"].map(
+                dict(AggregatedClassification.CLASSIFICATION_CHOICES)
+            ),
+            "Classification count": values["classification_count"],
+            "Folding flag": values["period_uncertainty"].map(
+                dict(AggregatedClassification.PERIOD_UNCERTAINTY_CHOICES)
+            ),
+            "Sigma": values["sigma"],
+            "Chi squared": values["chi_squared"],
+        }
+    )
+    url_prefix = f"https://{settings.ALLOWED_HOSTS[0]}"
+    has_fits = values["star__fits_file"].fillna("") != ""
+    for column, field in EXPORT_URL_FIELDS.items():
+        file_names = values[field].fillna("")
+        file_names = file_names.where(has_fits & (file_names != ""))
+        out[column] = file_names.map(
+            lambda name: url_prefix + default_storage.url(name), na_action="ignore"
+        ).fillna("")
     return out
 
 
+def write_export_csv(records, csv_file, update_progress=None):
+    """
+    Writes export records (as yielded by gen_export_records) to a text file as CSV.
+    """
+    csv.writer(csv_file).writerow(EXPORT_DATA_DESCRIPTION.keys())
+    exported_records = 0
+    for frame in records:
+        if update_progress:
+            update_progress(exported_records)
+        frame.to_csv(csv_file, header=False, index=False, lineterminator="\r\n")
+        exported_records += len(frame)
+    return exported_records
+
+
+def write_export_fits(records, fits_file, update_progress=None):
+    """
+    Writes export records (as yielded by gen_export_records with sexagesimal=False)
+    to a binary file as a FITS binary table.
+
+    Rows are staged in a temporary file as they arrive, so that the table header can
+    be written with the final row count without holding the table in memory.
+    """
+    columns = fits.ColDefs(
+        [
+            fits.Column(name=name, format=column_format)
+            for name, column_format in EXPORT_FITS_FORMATS.items()
+        ]
+    )
+    # FITS tables are big-endian
+    dtype = columns.dtype.newbyteorder(">")
+    exported_records = 0
+    with tempfile.TemporaryFile() as staged_rows:
+        for frame in records:
+            if update_progress:
+                update_progress(exported_records)
+            rows = numpy.empty(len(frame), dtype=dtype)
+            for name in dtype.names:
+                if dtype[name].kind == "S":
+                    rows[name] = frame[name].fillna("").to_numpy(dtype=str)
+                elif dtype[name].kind == "f":
+                    rows[name] = frame[name].to_numpy(dtype=float, na_value=numpy.nan)
+                else:
+                    rows[name] = frame[name].to_numpy()
+            staged_rows.write(rows.tobytes())
+            exported_records += len(frame)
+
+        table_hdu = fits.BinTableHDU.from_columns(columns, nrows=0)
+        table_hdu.header["NAXIS2"] = exported_records
+        fits_file.write(fits.PrimaryHDU().header.tostring().encode("ascii"))
+        fits_file.write(table_hdu.header.tostring().encode("ascii"))
+        staged_rows.seek(0)
+        shutil.copyfileobj(staged_rows, fits_file)
+        fits_file.write(
+            b"\0" * (-exported_records * dtype.itemsize % FITS_BLOCK_SIZE)
+        )
+    return exported_records
+
+
 class GenerateExportView(View):
     def get(self, request):
         return HttpResponseRedirect(reverse("vespa"))
@@ -311,6 +492,9 @@ class GenerateExportView(View):
                 ),
                 search=request.POST.get("search", None),
                 search_radius=search_radius,
+                export_format=DataExport.FORMAT_CHOICES_DICT[
+                    request.POST.get("export_format", "csv")
+                ],
             )
             if export.export_status == DataExport.STATUS_FAILED:
                 export.export_status = DataExport.STATUS_PENDING
@@ -322,7 +506,7 @@ class GenerateExportView(View):
                 )
             except NoReverseMatch:
                 raise Http404
-        except (ValueError, TypeError):
+        except (ValueError, TypeError, KeyError):
             return HttpResponseBadRequest("Bad Request")
 
 
@@ -63,6 +63,18 @@ class SPointField(models.Field):
             raise TypeError("Lookup type %r not supported." % lookup_type)
 
 
+class SPointIndex(models.Index):
+    """
+    A GiST index on an spoint column. This is what lets pgsphere use an index for
+    inradius lookups and for ordering by Distance (nearest neighbour search).
+    """
+
+    suffix = "spoint"
+
+    def create_sql(self, model, schema_editor, using="", **kwargs):
+        return super().create_sql(model, schema_editor, using=" USING gist", **kwargs)
+
+
 @SPointField.register_lookup
 class SPointIn(models.Lookup):
     lookup_name = "inradius"
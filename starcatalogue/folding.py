@@ -0,0 +1,56 @@
+import numpy
+
+
+def fold_phase(time, periods, epoch=None):
+    """
+    Returns the phase, in [0, 1), of each time folded at the given period(s).
+
+    If periods is an array, the result has one row for each period, so that a star
+    can be folded at many candidate periods in one call. Times and periods must be
+    in the same units. The epoch defaults to the first time.
+    """
+    time = numpy.asarray(time, dtype=numpy.float64)
+    if epoch is None:
+        epoch = time[0] if len(time) else 0.0
+    periods = numpy.asarray(periods, dtype=numpy.float64)
+    offsets = time - epoch
+    if periods.ndim:
+        offsets = offsets[numpy.newaxis, :]
+        periods = periods[:, numpy.newaxis]
+    return numpy.mod(offsets / periods, 1.0)
+
+
+def repeat_cycles(phase, flux, cycles=2):
+    """
+    Repeats folded phase (along its last axis) and flux for the given number of
+    cycles. The phase of the result runs from -cycles / 2 to cycles / 2, with the
+    epoch half a cycle either side of zero, as the images folded with
+    TimeSeries.fold always were.
+    """
+    phase = numpy.mod(phase + 0.5, 1.0) - 0.5
+    phase = numpy.concatenate(
+        [phase + (cycle - (cycles - 1) / 2) for cycle in range(cycles)], axis=-1
+    )
+    if numpy.ma.isMaskedArray(flux):
+        flux = numpy.ma.concatenate([flux] * cycles)
+    else:
+        flux = numpy.tile(flux, cycles)
+    return phase, flux
+
+
+def fold(time, flux, period, cycles=2, epoch=None):
+    """
+    Folds a lightcurve at one period, returning (phase, flux) for the given number
+    of cycles.
+    """
+    return repeat_cycles(fold_phase(time, period, epoch), flux, cycles)
+
+
+def fold_many(time, flux, periods, cycles=2, epoch=None):
+    """
+    Folds a lightcurve at many periods at once. Returns a (len(periods), n) array
+    of phases and the flux shared by every row.
+    """
+    return repeat_cycles(
+        fold_phase(time, numpy.atleast_1d(periods), epoch), flux, cycles
+    )
@@ -0,0 +1,151 @@
+import time
+
+import numpy
+import pandas
+
+from django.core.management.base import BaseCommand
+
+from starcatalogue.releases import (
+    CLASSIFICATION_COLUMNS,
+    PERIOD_CERTAINTIES,
+    PERIOD_CERTAINTY_OVERRIDES,
+    aggregate_votes,
+)
+
+
+def make_synthetic_classifications(classifications, subjects, users, seed):
+    """
+    Generates classifications like the ones prepare_data_release reads from the
+    Zooniverse export.
+    """
+    rng = numpy.random.default_rng(seed)
+    classification = rng.choice(
+        CLASSIFICATION_COLUMNS, classifications, p=[0.2, 0.2, 0.15, 0.2, 0.15, 0.1]
+    )
+    certainty = rng.choice(PERIOD_CERTAINTIES + ["None"], classifications)
+    certainty = pandas.Series(classification).map(PERIOD_CERTAINTY_OVERRIDES).fillna(
+        pandas.Series(certainty)
+    )
+    frame = pandas.DataFrame(
+        {
+            "subject_id": rng.integers(1, subjects + 1, classifications),
+            "classification": classification,
+            "period_certainty": classification + " " + certainty,
+            "user_name": "user" + rng.integers(0, users, classifications).astype(str),
+        }
+    )
+    return frame.drop_duplicates(subset=["user_name", "subject_id"])
+
+
+def aggregate_votes_iterrows(classifications):
+    # The pivot tables and per-subject loop which aggregate_votes replaced
+    aggregated_classifications = classifications.pivot_table(
+        columns=["classification"],
+        values="user_name",
+        index="subject_id",
+        aggfunc=len,
+        fill_value=0,
+    )
+    aggregated_classifications["consensus class"] = aggregated_classifications[
+        CLASSIFICATION_COLUMNS
+    ].idxmax(axis="columns")
+    aggregated_classifications = aggregated_classifications.join(
+        classifications.pivot_table(
+            columns=["period_certainty"],
+            values="user_name",
+            index="subject_id",
+            aggfunc=len,
+            fill_value=0,
+        )
+    )
+    aggregated_classifications = aggregated_classifications[
+        aggregated_classifications["consensus class"] != "Junk"
+    ]
+
+    results = {}
+    for subject_id, row in aggregated_classifications.iterrows():
+        if row["consensus class"] in PERIOD_CERTAINTY_OVERRIDES:
+            period_certainty = PERIOD_CERTAINTY_OVERRIDES[row["consensus class"]]
+        else:
+            column_order = [
+                f"{row['consensus class']} Correct period",
+                f"{row['consensus class']} Wrong period",
+            ]
+            if row["consensus class"] != "Pulsator":
+                column_order = [
+                    f"{row['consensus class']} Half correct period",
+                ] + column_order
+            period_certainty = (
+                pandas.to_numeric(row[column_order])
+                .idxmax()
+                .replace(f"{row['consensus class']} ", "")
+            )
+        results[subject_id] = (
+            row["consensus class"],
+            period_certainty,
+            sum(row[t] for t in CLASSIFICATION_COLUMNS),
+        )
+    return results
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the vectorised classification voting with the old per-subject "
+        "loop on a synthetic classification export"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--classifications", type=int, default=1000000)
+        parser.add_argument("--subjects", type=int, default=100000)
+        parser.add_argument("--users", type=int, default=5000)
+        parser.add_argument(
+            "--loop-subjects",
+            type=int,
+            default=5000,
+            help="Number of subjects to time the old loop on, as it's much slower",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        classifications = make_synthetic_classifications(
+            options["classifications"],
+            options["subjects"],
+            options["users"],
+            options["seed"],
+        )
+        subset = classifications[
+            classifications["subject_id"] <= options["loop_subjects"]
+        ]
+        print(
+            f"{len(classifications)} classifications of "
+            f"{classifications['subject_id'].nunique()} subjects"
+        )
+
+        start = time.perf_counter()
+        aggregated_classifications = aggregate_votes(classifications)
+        elapsed = time.perf_counter() - start
+        print(
+            f"aggregate_votes: {elapsed:.2f}s "
+            f"({classifications['subject_id'].nunique() / elapsed:.0f} subjects/second)"
+        )
+
+        start = time.perf_counter()
+        loop_results = aggregate_votes_iterrows(subset)
+        elapsed = time.perf_counter() - start
+        print(
+            f"iterrows: {elapsed:.2f}s for {subset['subject_id'].nunique()} subjects "
+            f"({subset['subject_id'].nunique() / elapsed:.0f} subjects/second)"
+        )
+
+        # Both should reach the same results
+        vectorised_results = {
+            subject_id: (consensus, certainty, count)
+            for subject_id, consensus, certainty, count in aggregate_votes(subset)[
+                ["consensus class", "period certainty", "classification count"]
+            ].itertuples()
+        }
+        mismatches = sum(
+            loop_results.get(subject_id) != result
+            for subject_id, result in vectorised_results.items()
+        ) + len(loop_results.keys() - vectorised_results.keys())
+        print(f"Mismatched subjects: {mismatches}")
@@ -0,0 +1,57 @@
+import io
+import time
+
+import numpy
+import seaborn
+
+from django.core.management.base import BaseCommand
+
+from matplotlib import pyplot
+from PIL import Image
+
+from starcatalogue.rendering import THUMBNAIL_SIZE, LightcurveRenderer
+
+
+def render_seaborn(x, y, title):
+    # The per-image pyplot and seaborn path the renderer replaced
+    fig = pyplot.figure()
+    plot = seaborn.scatterplot(data={"x": x, "y": y}, x="x", y="y", alpha=0.5, s=1)
+    plot.set_title(title)
+    image_data = io.BytesIO()
+    fig.savefig(image_data)
+    thumbnail = Image.open(image_data)
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    thumbnail.save(io.BytesIO(), format="png")
+    pyplot.close()
+
+
+class Command(BaseCommand):
+    help = "Compares the lightcurve image renderer with the old seaborn path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", type=int, default=20)
+        parser.add_argument("--points", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        pyplot.switch_backend("agg")
+        rng = numpy.random.default_rng()
+        x = rng.uniform(-1, 1, options["points"])
+        y = rng.normal(1000, 50, options["points"])
+        renderer = LightcurveRenderer()
+        density_renderer = LightcurveRenderer(density_threshold=0)
+
+        for name, render in (
+            ("seaborn", lambda: render_seaborn(x, y, "Benchmark")),
+            ("renderer", lambda: renderer.render(x, y, "Benchmark", "phase")),
+            (
+                "renderer (density)",
+                lambda: density_renderer.render(x, y, "Benchmark", "phase"),
+            ),
+        ):
+            # Once untimed, so imports and font caches don't count
+            render()
+            start = time.perf_counter()
+            for i in range(options["images"]):
+                render()
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {options['images'] / elapsed:.2f} images/second")
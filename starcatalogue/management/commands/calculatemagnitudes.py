@@ -0,0 +1,44 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from starcatalogue.caching import invalidate_results_cache
+from starcatalogue.models import MAGNITUDE_CHUNK_SIZE, Star
+
+
+class Command(BaseCommand):
+    help = "Calculates the magnitudes of every star which needs them, in bulk"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=None)
+        parser.add_argument("--processes", type=int, default=os.cpu_count())
+        parser.add_argument("--chunk-size", type=int, default=MAGNITUDE_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        star_ids = Star.objects.filter(
+            fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
+        ).filter(Star.needs_magnitudes())
+        star_ids = list(
+            star_ids.order_by("id").values_list("id", flat=True)[: options["limit"]]
+        )
+        print(f"Calculating magnitudes for {len(star_ids)} stars")
+
+        start = time.perf_counter()
+        updated = 0
+        for chunk_updated in Star.update_magnitudes(
+            star_ids,
+            processes=options["processes"],
+            chunk_size=options["chunk_size"],
+        ):
+            updated += chunk_updated
+            elapsed = time.perf_counter() - start
+            print(f"Updated {updated} ({updated / elapsed:.1f} stars/s)")
+        if updated:
+            invalidate_results_cache()
+        elapsed = time.perf_counter() - start
+        print(
+            f"Updated {updated} stars in {elapsed:.1f}s "
+            f"({updated / max(elapsed, 1e-9):.1f} stars/s)"
+        )
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from starcatalogue.models import Star
+from starcatalogue.tasks import download_fits_files
+
+
+class Command(BaseCommand):
+    help = "Downloads the FITS files for stars which don't have one yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=None)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--concurrency", type=int, default=settings.FITS_DOWNLOAD_CONCURRENCY
+        )
+
+    def handle(self, *args, **options):
+        missing = (
+            Star.objects.filter(Q(fits_file=None) | Q(fits_file=""))
+            .filter(fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS)
+            .order_by("id")
+        )
+        last_id = 0
+        saved = 0
+        remaining = options["limit"]
+        while remaining is None or remaining > 0:
+            batch_size = options["batch_size"]
+            if remaining is not None:
+                batch_size = min(batch_size, remaining)
+                remaining -= batch_size
+            star_ids = list(
+                missing.filter(id__gt=last_id).values_list("id", flat=True)[
+                    :batch_size
+                ]
+            )
+            if not star_ids:
+                break
+            last_id = star_ids[-1]
+            saved += download_fits_files(star_ids, concurrency=options["concurrency"])
+            print(f"Downloaded {saved}")
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from starcatalogue.models import Star, StagedFITSFile
+from starcatalogue.tasks import process_fits
+
+
+class Command(BaseCommand):
+    help = (
+        "Indexes the FITS files staged in MEDIA_ROOT/missing and moves them into "
+        "place for the stars which don't have one yet"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rescan",
+            action="store_true",
+            help="List batch directories which have already been indexed again",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--index-only",
+            action="store_true",
+            help="Update the index without ingesting anything",
+        )
+
+    def handle(self, *args, **options):
+        added = StagedFITSFile.update_index(rescan=options["rescan"])
+        print(f"Indexed {added} new files")
+        if options["index_only"]:
+            return
+
+        last_id = 0
+        ingested = 0
+        while True:
+            staged_files = list(
+                StagedFITSFile.objects.filter(id__gt=last_id).order_by("id")[
+                    : options["batch_size"]
+                ]
+            )
+            if not staged_files:
+                break
+            last_id = staged_files[-1].id
+            star_ids = Star.objects.filter(
+                superwasp_id__in=[staged.superwasp_id for staged in staged_files]
+            ).values_list("id", flat=True)
+            stars = Star.claim_fits_downloads(list(star_ids))
+            for staged in staged_files:
+                star = stars.get(staged.superwasp_id)
+                if star is None:
+                    continue
+                if staged.ingest(star):
+                    process_fits.delay(star.id)
+                    ingested += 1
+                else:
+                    star.set_asset_status("fits_status", star.ASSET_MISSING)
+            print(f"Ingested {ingested}")
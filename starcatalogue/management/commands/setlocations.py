@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from starcatalogue.caching import invalidate_results_cache
+from starcatalogue.models import LOCATION_BATCH_SIZE, Star
+
+
+class Command(BaseCommand):
+    help = "Sets the location of every star which doesn't have one yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=LOCATION_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        updated = Star.set_locations(batch_size=options["batch_size"])
+        if updated:
+            invalidate_results_cache()
+        print(f"Updated {updated}")
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0046_dataexport__object_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataexport',
+            name='export_format',
+            field=models.IntegerField(choices=[(0, 'CSV'), (1, 'FITS')], default=0),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:11
+
+import django.db.models.deletion
+import starcatalogue.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0047_dataexport_export_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogueEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('superwasp_id', models.CharField(max_length=26)),
+                ('period_length', models.FloatField(null=True)),
+                ('sigma', models.FloatField(null=True)),
+                ('chi_squared', models.FloatField(null=True)),
+                ('classification', models.IntegerField(choices=[(1, 'Pulsator'), (2, 'EA/EB'), (3, 'EW'), (4, 'Rotator'), (5, 'Unknown'), (6, 'Junk')])),
+                ('period_uncertainty', models.IntegerField(choices=[(0, 'Certain'), (1, 'Uncertain'), (2, 'Half')])),
+                ('classification_count', models.IntegerField()),
+                ('mean_magnitude', models.FloatField(null=True)),
+                ('min_magnitude', models.FloatField(null=True)),
+                ('max_magnitude', models.FloatField(null=True)),
+                ('amplitude', models.FloatField(null=True)),
+                ('location', starcatalogue.fields.SPointField(null=True)),
+                ('aggregated_classification', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='starcatalogue.aggregatedclassification')),
+                ('data_release', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='starcatalogue.datarelease')),
+                ('lightcurve', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='starcatalogue.foldedlightcurve')),
+                ('star', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='starcatalogue.star')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['data_release', 'superwasp_id'], name='starcatalog_data_re_df96b2_idx'), models.Index(fields=['data_release', 'period_length'], name='starcatalog_data_re_bc5ae0_idx'), models.Index(fields=['data_release', 'classification'], name='starcatalog_data_re_5d05cc_idx'), models.Index(fields=['data_release', 'classification_count'], name='starcatalog_data_re_b26dc2_idx'), models.Index(fields=['data_release', 'mean_magnitude'], name='starcatalog_data_re_7b85df_idx'), models.Index(fields=['data_release', 'amplitude'], name='starcatalog_data_re_6b41ea_idx')],
+            },
+        ),
+    ]
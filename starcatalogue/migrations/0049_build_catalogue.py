@@ -0,0 +1,68 @@
+import itertools
+
+from decimal import Decimal
+
+from django.db import migrations
+from django.db.models import Q
+
+
+CHUNK_SIZE = 5000
+
+SOURCE_FIELDS = {
+    "aggregated_classification_id": "id",
+    "data_release_id": "data_release_id",
+    "lightcurve_id": "lightcurve_id",
+    "star_id": "lightcurve__star_id",
+    "superwasp_id": "lightcurve__star__superwasp_id",
+    "period_length": "lightcurve__period_length",
+    "sigma": "lightcurve__sigma",
+    "chi_squared": "lightcurve__chi_squared",
+    "classification": "classification",
+    "period_uncertainty": "period_uncertainty",
+    "classification_count": "classification_count",
+    "mean_magnitude": "lightcurve__star___mean_magnitude",
+    "min_magnitude": "lightcurve__star___min_magnitude",
+    "max_magnitude": "lightcurve__star___max_magnitude",
+    "amplitude": "lightcurve__star___amplitude",
+    "location": "lightcurve__star__location",
+}
+
+
+def build_active_catalogues(apps, schema_editor):
+    AggregatedClassification = apps.get_model(
+        "starcatalogue", "AggregatedClassification"
+    )
+    CatalogueEntry = apps.get_model("starcatalogue", "CatalogueEntry")
+
+    rows = (
+        AggregatedClassification.objects.filter(data_release__active=True)
+        .filter(
+            ~Q(lightcurve__sigma=Decimal("NaN"))
+            & ~Q(lightcurve__chi_squared=Decimal("NaN"))
+            & ~Q(lightcurve__period_length=Decimal("NaN"))
+        )
+        .values_list(*SOURCE_FIELDS.values())
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK_SIZE))
+        if not chunk:
+            break
+        CatalogueEntry.objects.bulk_create(
+            [CatalogueEntry(**dict(zip(SOURCE_FIELDS.keys(), row))) for row in chunk]
+        )
+
+
+def remove_catalogues(apps, schema_editor):
+    apps.get_model("starcatalogue", "CatalogueEntry").objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("starcatalogue", "0048_catalogueentry"),
+    ]
+
+    operations = [
+        migrations.RunPython(build_active_catalogues, remove_catalogues),
+    ]
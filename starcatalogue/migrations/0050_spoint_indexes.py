@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:13
+
+import starcatalogue.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0049_build_catalogue'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='catalogueentry',
+            index=starcatalogue.fields.SPointIndex(fields=['location'], name='catalogue_location_spoint'),
+        ),
+        migrations.AddIndex(
+            model_name='star',
+            index=starcatalogue.fields.SPointIndex(fields=['location'], name='star_location_spoint'),
+        ),
+    ]
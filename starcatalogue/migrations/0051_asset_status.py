@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0050_spoint_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foldedlightcurve',
+            name='image_status',
+            field=models.IntegerField(choices=[(0, 'Missing'), (1, 'Queued'), (2, 'Running'), (3, 'Complete'), (4, 'Failed')], db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='star',
+            name='fits_status',
+            field=models.IntegerField(choices=[(0, 'Missing'), (1, 'Queued'), (2, 'Running'), (3, 'Complete'), (4, 'Failed')], db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='star',
+            name='image_status',
+            field=models.IntegerField(choices=[(0, 'Missing'), (1, 'Queued'), (2, 'Running'), (3, 'Complete'), (4, 'Failed')], db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='star',
+            name='json_status',
+            field=models.IntegerField(choices=[(0, 'Missing'), (1, 'Queued'), (2, 'Running'), (3, 'Complete'), (4, 'Failed')], db_index=True, default=0),
+        ),
+    ]
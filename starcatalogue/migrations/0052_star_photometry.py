@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:19
+
+import starcatalogue.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0051_asset_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='star',
+            name='photometry_file',
+            field=models.FileField(null=True, upload_to=starcatalogue.models.star_photometry_upload_to),
+        ),
+        migrations.AddField(
+            model_name='star',
+            name='photometry_version',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:24
+
+import starcatalogue.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0052_star_photometry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='star',
+            name='lightcurve_data_file',
+            field=models.FileField(null=True, upload_to=starcatalogue.models.star_json_upload_to),
+        ),
+        migrations.AddField(
+            model_name='star',
+            name='lightcurve_data_levels',
+            field=models.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0053_star_lightcurve_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedFITSFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('superwasp_id', models.CharField(max_length=26, unique=True)),
+                ('batch', models.CharField(db_index=True, max_length=255)),
+            ],
+        ),
+    ]
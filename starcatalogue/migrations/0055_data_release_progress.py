@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0054_staged_fits_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datarelease',
+            name='progress',
+            field=models.FloatField(default=0.0),
+        ),
+    ]
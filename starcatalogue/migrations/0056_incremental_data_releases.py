@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('starcatalogue', '0055_data_release_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datarelease',
+            name='base_release',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='starcatalogue.datarelease'),
+        ),
+        migrations.AddField(
+            model_name='datarelease',
+            name='incremental',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='datarelease',
+            name='last_classification_id',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+    ]
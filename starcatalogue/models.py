@@ -1,30 +1,51 @@
+import collections
+import concurrent.futures
 import datetime
+import functools
+import itertools
 import logging
 import math
+import multiprocessing
+import os
+import re
 import urllib
 
+from decimal import Decimal
+from pathlib import Path
+
 import numpy
 
 from django.conf import settings
-from django.db import models
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Q, Subquery
 from django.urls import reverse
 from django.utils import timezone
 
 import astropy.io.fits as fits
 from astropy import units
 from astropy.coordinates import SkyCoord
-from astropy.stats import sigma_clip
 from astropy.timeseries import TimeSeries
 
-from celery.result import AsyncResult
 from humanize.time import naturaldelta
 from humanize import naturalsize
 
-from .fields import SPointField
+from .fields import SPointField, SPointIndex
+from .folding import fold
+from .photometry import SECONDS_PER_DAY, Photometry, clip_outliers
+from .statistics import photometry_magnitude_stats
+
 
+# SuperWASP IDs are fixed width: 1SWASPJhhmmss.ss+ddmmss.s
+SUPERWASP_ID_LENGTH = 25
+SUPERWASP_ID_PATTERN = re.compile(r"1SWASPJ\d{6}\.\d{2}[+-]\d{6}\.\d")
 
-OUTLIER_SIGMA_CLIP = 5
-FLUX_MAX_CLIP = 2e5
+# Number of stars whose locations are parsed and written per bulk update
+LOCATION_BATCH_SIZE = 10000
+
+# Number of stars whose magnitudes are calculated together and bulk updated
+MAGNITUDE_CHUNK_SIZE = 1000
 
 logger = logging.getLogger(__name__)
 
@@ -45,78 +66,179 @@ def star_json_upload_to(instance, filename):
     )
 
 
+def star_photometry_upload_to(instance, filename):
+    return f"sources/{instance.superwasp_id}/v{instance.CURRENT_PHOTOMETRY_VERSION}_{filename}"
+
+
 def lightcurve_upload_to(instance, filename):
     return f"sources/{instance.star.superwasp_id}/v{instance.CURRENT_IMAGE_VERSION}_{filename}"
 
 
-class ImageGenerator(object):
-    def get_or_generate_image(self, image_attr, generation_task, default=None):
-        image_not_present = not image_attr or not self.image_version
-        image_outdated = (
-            self.image_version and self.image_version < self.CURRENT_IMAGE_VERSION
+class AssetGenerator(object):
+    """
+    Tracks the state of the Celery tasks which generate files for a model, so that
+    rendering a page never needs to ask the result backend.
+    """
+
+    ASSET_MISSING = 0
+    ASSET_QUEUED = 1
+    ASSET_RUNNING = 2
+    ASSET_COMPLETE = 3
+    ASSET_FAILED = 4
+    ASSET_STATUS_CHOICES = (
+        (ASSET_MISSING, "Missing"),
+        (ASSET_QUEUED, "Queued"),
+        (ASSET_RUNNING, "Running"),
+        (ASSET_COMPLETE, "Complete"),
+        (ASSET_FAILED, "Failed"),
+    )
+    # Tasks which have been queued or running for longer than this are assumed lost
+    ASSET_TASK_TIMEOUT = datetime.timedelta(minutes=5)
+
+    @classmethod
+    def asset_in_progress(cls, status_attr, started_attr):
+        """
+        Returns a Q matching rows which have a generation task in flight.
+        """
+        return Q(**{f"{status_attr}__in": (cls.ASSET_QUEUED, cls.ASSET_RUNNING)}) & Q(
+            **{f"{started_attr}__gte": timezone.now() - cls.ASSET_TASK_TIMEOUT}
         )
-        if image_not_present or image_outdated:
-            if (
-                not self.images_celery_task_id
-                or AsyncResult(self.images_celery_task_id).ready()
-                or not self.image_celery_started
-                or self.image_celery_started
-                < (timezone.now() - datetime.timedelta(minutes=5))
-            ):
-                self.images_celery_task_id = generation_task.delay(self.id).id
-                self.image_celery_started = timezone.now()
-                self.save()
-            if image_not_present:
-                return default
-        elif self.images_celery_task_id:
-            AsyncResult(self.images_celery_task_id).forget()
-        return image_attr.url
 
+    def queue_asset(
+        self, status_attr, started_attr, task_id_attr, generation_task, **options
+    ):
+        """
+        Queues generation_task unless one is already in flight for this object.
+
+        The status is claimed with a single conditional UPDATE, so concurrent
+        callers can't queue the same task twice. Returns True if a task was queued.
+        """
+        now = timezone.now()
+        queryset = type(self).objects.filter(pk=self.pk)
+        claimed = queryset.exclude(
+            self.asset_in_progress(status_attr, started_attr)
+        ).update(**{status_attr: self.ASSET_QUEUED, started_attr: now})
+        if not claimed:
+            return False
+        task_id = generation_task.apply_async((self.pk,), **options).id
+        queryset.update(**{task_id_attr: task_id})
+        setattr(self, status_attr, self.ASSET_QUEUED)
+        setattr(self, started_attr, now)
+        setattr(self, task_id_attr, task_id)
+        return True
+
+    def set_asset_status(self, status_attr, status):
+        type(self).objects.filter(pk=self.pk).update(**{status_attr: status})
+        setattr(self, status_attr, status)
+
+
+class ImageGenerator(AssetGenerator):
+    @property
+    def image_outdated(self):
+        return not self.image_version or self.image_version < self.CURRENT_IMAGE_VERSION
+
+    def get_image_url(self, image_attr, default=None):
+        if not image_attr or not self.image_version:
+            return default
+        return image_attr.url
 
-class JSONGenerator(object):
-    def get_or_generate_json(self, json_attr, generation_task, default=None):
-        json_not_present = not json_attr or not self.json_version
-        json_outdated = (
-            self.json_version and self.json_version < self.CURRENT_JSON_VERSION
+    def queue_image_generation(self, generation_task):
+        if not self.image_outdated:
+            return False
+        return self.queue_asset(
+            "image_status",
+            "image_celery_started",
+            "images_celery_task_id",
+            generation_task,
         )
-        if json_not_present or json_outdated:
-            if (
-                not self.json_files_celery_task_id
-                or AsyncResult(self.json_files_celery_task_id).ready()
-                or not self.json_celery_started
-                or self.json_celery_started
-                < (timezone.now() - datetime.timedelta(minutes=5))
-            ):
-                self.json_files_celery_task_id = generation_task.delay(self.id).id
-                self.json_celery_started = timezone.now()
-                self.save()
-            if json_not_present:
-                return default
-        elif self.json_files_celery_task_id:
-            AsyncResult(self.json_files_celery_task_id).forget()
+
+
+class JSONGenerator(AssetGenerator):
+    @property
+    def json_outdated(self):
+        return not self.json_version or self.json_version < self.CURRENT_JSON_VERSION
+
+    def get_json_url(self, json_attr, default=None):
+        if not json_attr or not self.json_version:
+            return default
         return json_attr.url
 
+    def queue_json_generation(self, generation_task):
+        if not self.json_outdated:
+            return False
+        return self.queue_asset(
+            "json_status",
+            "json_celery_started",
+            "json_files_celery_task_id",
+            generation_task,
+        )
+
+
+class SuperWASPCoordinates(object):
+    """
+    Sky coordinates parsed from a model's superwasp_id.
+    """
 
-class Star(models.Model, ImageGenerator, JSONGenerator):
-    CURRENT_IMAGE_VERSION = 0.92
-    CURRENT_JSON_VERSION = 0.3
+    @property
+    def coords_str(self):
+        return self.superwasp_id.replace("1SWASP", "")
+
+    @functools.cached_property
+    def coords(self):
+        return SkyCoord(self.coords_str, unit=(units.hour, units.deg))
+
+    @functools.cached_property
+    def ra(self):
+        return self.coords.ra.to_string(units.hour)
+
+    @functools.cached_property
+    def dec(self):
+        return self.coords.dec.to_string(units.deg)
+
+
+class Star(models.Model, ImageGenerator, JSONGenerator, SuperWASPCoordinates):
+    CURRENT_IMAGE_VERSION = 0.93
+    CURRENT_JSON_VERSION = 0.4
     CURRENT_STATS_VERSION = 0.4
+    CURRENT_PHOTOMETRY_VERSION = 1.0
 
     superwasp_id = models.CharField(unique=True, max_length=26)
     fits_file = models.FileField(null=True, upload_to=star_upload_to)
     fits_celery_task_id = models.UUIDField(null=True)
     fits_celery_started = models.DateTimeField(null=True)
+    fits_status = models.IntegerField(
+        choices=AssetGenerator.ASSET_STATUS_CHOICES,
+        default=AssetGenerator.ASSET_MISSING,
+        db_index=True,
+    )
     fits_error_count = models.IntegerField(default=0)
 
     image_file = models.ImageField(null=True, upload_to=star_upload_to)
     images_celery_task_id = models.UUIDField(null=True)
     image_version = models.FloatField(null=True)
     image_celery_started = models.DateTimeField(null=True)
+    image_status = models.IntegerField(
+        choices=AssetGenerator.ASSET_STATUS_CHOICES,
+        default=AssetGenerator.ASSET_MISSING,
+        db_index=True,
+    )
 
     json_file = models.FileField(null=True, upload_to=star_json_upload_to)
+    # Compact binary copy of the JSON data for the source page, with downsampled
+    # levels. See downsampling.encode_levels.
+    lightcurve_data_file = models.FileField(null=True, upload_to=star_json_upload_to)
+    lightcurve_data_levels = models.JSONField(null=True)
     json_files_celery_task_id = models.UUIDField(null=True)
     json_version = models.FloatField(null=True)
     json_celery_started = models.DateTimeField(null=True)
+    json_status = models.IntegerField(
+        choices=AssetGenerator.ASSET_STATUS_CHOICES,
+        default=AssetGenerator.ASSET_MISSING,
+        db_index=True,
+    )
+
+    photometry_file = models.FileField(null=True, upload_to=star_photometry_upload_to)
+    photometry_version = models.FloatField(null=True)
 
     _min_magnitude = models.FloatField(null=True)
     _mean_magnitude = models.FloatField(null=True)
@@ -128,18 +250,48 @@ class Star(models.Model, ImageGenerator, JSONGenerator):
 
     created = models.DateTimeField(auto_now_add=True, null=True)
 
+    class Meta:
+        indexes = [
+            SPointIndex(fields=["location"], name="star_location_spoint"),
+        ]
+
     @classmethod
     def outlier_clip(cls, flux):
-        return sigma_clip(
-            numpy.ma.masked_greater(
-                numpy.ma.masked_less(
-                    flux,
-                    -FLUX_MAX_CLIP,
-                ),
-                FLUX_MAX_CLIP,
-            ),
-            sigma=OUTLIER_SIGMA_CLIP,
+        return clip_outliers(flux)
+
+    @classmethod
+    def parse_superwasp_ids(cls, superwasp_ids):
+        """
+        Parses many SuperWASP IDs at once, without creating a SkyCoord for each.
+
+        Returns a tuple of numpy arrays (ra, dec) in degrees.
+        """
+        ids = numpy.asarray(superwasp_ids, dtype="S").ravel()
+        if ids.size == 0:
+            return numpy.empty(0), numpy.empty(0)
+        if (
+            ids.dtype.itemsize != SUPERWASP_ID_LENGTH
+            or (numpy.char.str_len(ids) != SUPERWASP_ID_LENGTH).any()
+        ):
+            raise ValueError(
+                "SuperWASP IDs must be of the form 1SWASPJhhmmss.ss+ddmmss.s"
+            )
+        chars = ids.view(numpy.uint8).reshape(-1, SUPERWASP_ID_LENGTH)
+        digits = chars.astype(numpy.float64) - ord("0")
+
+        def pair(i):
+            return digits[:, i] * 10 + digits[:, i + 1]
+
+        ra_hours = (
+            pair(7)
+            + pair(9) / 60
+            + (pair(11) + digits[:, 14] / 10 + digits[:, 15] / 100) / 3600
+        )
+        dec_sign = numpy.where(chars[:, 16] == ord("-"), -1.0, 1.0)
+        dec = dec_sign * (
+            pair(17) + pair(19) / 60 + (pair(21) + digits[:, 24] / 10) / 3600
         )
+        return ra_hours * 15, dec
 
     def __str__(self):
         return self.superwasp_id
@@ -152,26 +304,10 @@ class Star(models.Model, ImageGenerator, JSONGenerator):
             },
         )
 
-    @property
-    def coords_str(self):
-        return self.superwasp_id.replace("1SWASP", "")
-
-    @property
-    def coords(self):
-        return SkyCoord(self.coords_str, unit=(units.hour, units.deg))
-
     @property
     def coords_quoted(self):
         return urllib.parse.quote(self.coords_str)
 
-    @property
-    def ra(self):
-        return self.coords.ra.to_string(units.hour)
-
-    @property
-    def dec(self):
-        return self.coords.dec
-
     @property
     def ra_quoted(self):
         coords = self.coords_str
@@ -186,6 +322,52 @@ class Star(models.Model, ImageGenerator, JSONGenerator):
         coords = self.coords
         self.location = (coords.ra.to_value(), coords.dec.to_value())
         self.save()
+        CatalogueEntry.update_star(self)
+
+    @classmethod
+    def set_locations(cls, limit=None, batch_size=LOCATION_BATCH_SIZE):
+        """
+        Sets the location of every star which doesn't have one yet (up to limit),
+        parsing coordinates from the SuperWASP IDs a batch at a time. Stars with
+        malformed IDs are logged and skipped.
+
+        Returns the number of stars updated.
+        """
+        updated = 0
+        last_id = 0
+        while limit is None or updated < limit:
+            if limit is not None:
+                batch_size = min(batch_size, limit - updated)
+            batch = list(
+                cls.objects.filter(location=None, id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "superwasp_id")[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            valid_batch = []
+            for star_id, superwasp_id in batch:
+                if SUPERWASP_ID_PATTERN.fullmatch(superwasp_id):
+                    valid_batch.append((star_id, superwasp_id))
+                else:
+                    logger.warning(
+                        f"Could not set location of star {star_id} from "
+                        f"{superwasp_id!r}"
+                    )
+            if not valid_batch:
+                continue
+            star_ids, superwasp_ids = zip(*valid_batch)
+            ra, dec = cls.parse_superwasp_ids(superwasp_ids)
+            stars = [
+                cls(id=star_id, location=location)
+                for star_id, location in zip(star_ids, zip(ra.tolist(), dec.tolist()))
+            ]
+            with transaction.atomic():
+                cls.objects.bulk_update(stars, ["location"], batch_size=1000)
+                CatalogueEntry.update_locations(star_ids)
+            updated += len(stars)
+        return updated
 
     @property
     def lightcurve_classifications(self):
@@ -197,25 +379,63 @@ class Star(models.Model, ImageGenerator, JSONGenerator):
 
     @property
     def fits(self):
-        if not self.fits_file and (
-            not self.fits_celery_task_id
-            or AsyncResult(self.fits_celery_task_id).ready()
-            or not self.fits_celery_started
-            or self.fits_celery_started
-            < (timezone.now() - datetime.timedelta(minutes=5))
-        ):
-            self.fits_celery_task_id = download_fits.apply_async(
-                (self.id,),
-                expires=300,
-            ).id
-            self.fits_celery_started = timezone.now()
-            self.save()
-            return None
+        return self.fits_file or None
+
+    def queue_fits_download(self):
+        if self.fits_file or self.fits_error_count >= settings.FITS_DOWNLOAD_ATTEMPTS:
+            return False
+        return self.queue_asset(
+            "fits_status",
+            "fits_celery_started",
+            "fits_celery_task_id",
+            download_fits,
+            expires=300,
+        )
 
-        if self.fits_celery_task_id:
-            AsyncResult(self.fits_celery_task_id).forget()
+    @classmethod
+    def claim_fits_downloads(cls, star_ids):
+        """
+        Marks the stars which still need a FITS file as running, skipping any which
+        already have a download in flight. Returns the claimed stars by SuperWASP ID.
+        """
+        claimed_at = timezone.now()
+        cls.objects.filter(
+            Q(id__in=star_ids)
+            & Q(fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS)
+            & (Q(fits_file=None) | Q(fits_file=""))
+        ).exclude(cls.asset_in_progress("fits_status", "fits_celery_started")).update(
+            fits_status=cls.ASSET_RUNNING, fits_celery_started=claimed_at
+        )
+        return {
+            star.superwasp_id: star
+            for star in cls.objects.filter(
+                id__in=star_ids,
+                fits_status=cls.ASSET_RUNNING,
+                fits_celery_started=claimed_at,
+            )
+        }
 
-        return self.fits_file
+    def save_fits(self, fits_data):
+        if not isinstance(fits_data, File):
+            fits_data = File(fits_data)
+        self.fits_file.save(f"{self.superwasp_id}.fits", fits_data, save=False)
+        self.fits_status = self.ASSET_COMPLETE
+        self.save(update_fields=["fits_file", "fits_status"])
+
+    def fits_download_failed(self):
+        self.fits_error_count += 1
+        self.fits_status = self.ASSET_FAILED
+        self.save(update_fields=["fits_error_count", "fits_status"])
+
+    def process_fits(self):
+        """
+        Derives everything which comes from a newly downloaded FITS file. The
+        magnitudes are left to the calculate_magnitudes periodic task, which
+        calculates them in bulk and invalidates the results cache once per batch.
+        """
+        self.save_photometry()
+        self.queue_images()
+        self.queue_lightcurve_images()
 
     @property
     def fits_file_naturalsize(self):
@@ -246,19 +466,95 @@ class Star(models.Model, ImageGenerator, JSONGenerator):
             self.fits_error_count += 1
             self.save()
 
+    @property
+    def photometry(self):
+        """
+        Returns the star's Photometry, writing the photometry file from the FITS
+        file first if it's missing or out of date.
+        """
+        if not self.photometry_outdated:
+            try:
+                return Photometry.load(self.photometry_file.path)
+            except (OSError, ValueError):
+                logger.warning(
+                    f"Could not read photometry file {self.photometry_file.path} "
+                    f"for star {self.id}"
+                )
+        return self.save_photometry()
+
+    @property
+    def photometry_outdated(self):
+        return (
+            not self.photometry_file
+            or not self.photometry_version
+            or self.photometry_version < self.CURRENT_PHOTOMETRY_VERSION
+        )
+
+    def save_photometry(self):
+        if not self.fits:
+            return
+        try:
+            photometry = Photometry.from_fits(self.fits.path)
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(
+                f"Could not read FITS file {self.fits.path} for star {self.id}: {e}"
+            )
+            self.fits_file = None
+            self.fits_error_count += 1
+            self.save(update_fields=["fits_file", "fits_error_count"])
+            return
+        photometry_data = ContentFile(b"")
+        photometry.save(photometry_data)
+        self.photometry_file.save("photometry.npy", photometry_data, save=False)
+        self.photometry_version = self.CURRENT_PHOTOMETRY_VERSION
+        self.save(update_fields=["photometry_file", "photometry_version"])
+        return photometry
+
     @property
     def image_location(self):
         return self.get_image_location()
 
     def get_image_location(self):
-        return self.get_or_generate_image(self.image_file, generate_star_images)
+        return self.get_image_url(self.image_file)
+
+    def queue_images(self):
+        return self.queue_image_generation(generate_star_images)
 
     @property
     def json_location(self):
         return self.get_json_location()
 
     def get_json_location(self):
-        return self.get_or_generate_json(self.json_file, generate_star_json_files)
+        return self.get_json_url(self.json_file)
+
+    def queue_json_files(self):
+        return self.queue_json_generation(generate_star_json_files)
+
+    def queue_lightcurve_images(self):
+        """
+        Queues one task to render every outdated lightcurve image for this star.
+
+        The lightcurves are claimed with a single conditional UPDATE, so ones which
+        are already being rendered aren't queued again. Returns True if a task was
+        queued.
+        """
+        now = timezone.now()
+        claimed = (
+            self.foldedlightcurve_set.filter(FoldedLightcurve.needs_image())
+            .exclude(
+                FoldedLightcurve.asset_in_progress(
+                    "image_status", "image_celery_started"
+                )
+            )
+            .update(image_status=self.ASSET_QUEUED, image_celery_started=now)
+        )
+        if not claimed:
+            return False
+        task_id = generate_star_lightcurve_images.delay(self.id).id
+        self.foldedlightcurve_set.filter(image_celery_started=now).update(
+            images_celery_task_id=task_id
+        )
+        return True
 
     @property
     def cerit_url(self):
@@ -273,31 +569,115 @@ class Star(models.Model, ImageGenerator, JSONGenerator):
         return f"https://asas-sn.osu.edu/photometry?ra={self.ra_quoted}&dec={self.dec_quoted}&radius=2"
 
     def get_magnitude(self, attr_name="_mean_magnitude"):
-        if (
-            self.stats_version is None
-            or self.stats_version < self.CURRENT_STATS_VERSION
-            or getattr(self, attr_name) is None
-        ):
-            self.calculate_magnitudes()
-
+        # Missing or outdated magnitudes are filled in by the calculate_magnitudes
+        # periodic task, so that rendering never writes
         return getattr(self, attr_name)
 
-    def calculate_magnitudes(self):
-        agg_funcs = {
-            "_mean_magnitude": lambda x: x.mean(),
-            "_min_magnitude": lambda x: x.min(),
-            "_max_magnitude": lambda x: x.max(),
-        }
-        timeseries = self.timeseries
-        if not timeseries:
-            return
-        flux = Star.outlier_clip(timeseries["TAMFLUX2"])
-        for attr_name, agg_func in agg_funcs.items():
-            mag = 15 - 2.5 * numpy.log10(agg_func(flux))
-            setattr(self, attr_name, mag)
-        self._amplitude = self._min_magnitude - self._max_magnitude
+    MAGNITUDE_FIELDS = (
+        "_mean_magnitude",
+        "_min_magnitude",
+        "_max_magnitude",
+        "_amplitude",
+    )
+
+    @classmethod
+    def needs_magnitudes(cls):
+        """
+        Returns a Q matching stars with a FITS file whose magnitudes are missing or
+        out of date.
+        """
+        return Q(fits_file__isnull=False) & (
+            Q(_min_magnitude__isnull=True)
+            | Q(_max_magnitude__isnull=True)
+            | Q(_mean_magnitude__isnull=True)
+            | Q(stats_version__lt=cls.CURRENT_STATS_VERSION)
+            | Q(stats_version__isnull=True)
+        )
+
+    def set_magnitudes(self, stats):
+        """
+        Sets the magnitude fields from a row of statistics.magnitude_stats.
+        """
+        for attr_name, value in zip(self.MAGNITUDE_FIELDS, stats):
+            setattr(self, attr_name, float(value))
         self.stats_version = self.CURRENT_STATS_VERSION
-        self.save()
+
+    @classmethod
+    def update_magnitudes(cls, star_ids, processes=1, chunk_size=MAGNITUDE_CHUNK_SIZE):
+        """
+        Calculates the magnitudes of many stars, chunk_size stars at a time. Each
+        chunk's photometry files are reduced together, in a pool of processes if
+        processes > 1, and the results are written with one bulk update. Stars
+        whose photometry file is missing or out of date have it written from their
+        FITS file by the same worker first.
+
+        Yields the number of stars updated in each chunk. The results cache isn't
+        invalidated, so callers should do that once they're finished.
+        """
+
+        def load_chunks():
+            for start in range(0, len(star_ids), chunk_size):
+                stars = list(
+                    cls.objects.filter(id__in=star_ids[start : start + chunk_size])
+                )
+                fits_paths = []
+                for star in stars:
+                    if star.photometry_outdated:
+                        # Named as save_photometry would, and only saved if the
+                        # worker manages to write the file
+                        star.photometry_file.name = (
+                            star.photometry_file.field.generate_filename(
+                                star, "photometry.npy"
+                            )
+                        )
+                        star.photometry_version = cls.CURRENT_PHOTOMETRY_VERSION
+                        fits_paths.append(star.fits_file.path)
+                    else:
+                        fits_paths.append(None)
+                yield stars, [star.photometry_file.path for star in stars], fits_paths
+
+        def save_chunk(stars, results):
+            stats, readable, bad_fits = results
+            failed_ids = [star.id for star, bad in zip(stars, bad_fits) if bad]
+            stars = [star for star, ok in zip(stars, readable) if ok]
+            for star, star_stats in zip(stars, stats[readable]):
+                star.set_magnitudes(star_stats)
+            with transaction.atomic():
+                cls.objects.bulk_update(
+                    stars,
+                    cls.MAGNITUDE_FIELDS
+                    + ("stats_version", "photometry_file", "photometry_version"),
+                    batch_size=1000,
+                )
+                CatalogueEntry.update_magnitudes([star.id for star in stars])
+                # The FITS file will be downloaded again
+                cls.objects.filter(id__in=failed_ids).update(
+                    fits_file=None, fits_error_count=F("fits_error_count") + 1
+                )
+            return len(stars)
+
+        if processes <= 1:
+            for stars, paths, fits_paths in load_chunks():
+                yield save_chunk(stars, photometry_magnitude_stats(paths, fits_paths))
+            return
+
+        pending = collections.deque()
+        # The workers don't use Django, so they're spawned rather than forked to keep
+        # them clear of this process's database connections
+        with concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            for stars, paths, fits_paths in load_chunks():
+                pending.append(
+                    (stars, pool.submit(photometry_magnitude_stats, paths, fits_paths))
+                )
+                # Keep the workers busy without loading every chunk up front
+                if len(pending) > processes * 2:
+                    stars, future = pending.popleft()
+                    yield save_chunk(stars, future.result())
+            while pending:
+                stars, future = pending.popleft()
+                yield save_chunk(stars, future.result())
 
     @property
     def mean_magnitude(self):
@@ -317,7 +697,7 @@ class Star(models.Model, ImageGenerator, JSONGenerator):
 
 
 class FoldedLightcurve(models.Model, ImageGenerator):
-    CURRENT_IMAGE_VERSION = 1.0
+    CURRENT_IMAGE_VERSION = 1.1
 
     star = models.ForeignKey(to=Star, on_delete=models.CASCADE)
 
@@ -336,6 +716,11 @@ class FoldedLightcurve(models.Model, ImageGenerator):
     images_celery_task_id = models.UUIDField(null=True)
     image_version = models.FloatField(null=True)
     image_celery_started = models.DateTimeField(null=True)
+    image_status = models.IntegerField(
+        choices=AssetGenerator.ASSET_STATUS_CHOICES,
+        default=AssetGenerator.ASSET_MISSING,
+        db_index=True,
+    )
 
     created = models.DateTimeField(auto_now_add=True, null=True)
 
@@ -367,10 +752,23 @@ class FoldedLightcurve(models.Model, ImageGenerator):
             zoo_image = self.zooniversesubject.image_location
         except ZooniverseSubject.DoesNotExist:
             zoo_image = None
-        return self.get_or_generate_image(
-            self.image_file,
-            generate_lightcurve_images,
-            zoo_image,
+        return self.get_image_url(self.image_file, zoo_image)
+
+    def queue_images(self):
+        return self.queue_image_generation(generate_lightcurve_images)
+
+    @classmethod
+    def needs_image(cls):
+        """
+        Returns a Q matching lightcurves with a valid period whose images are
+        missing or out of date.
+        """
+        return (
+            Q(image_version=None) | Q(image_version__lt=cls.CURRENT_IMAGE_VERSION)
+        ) & (
+            ~Q(sigma=Decimal("NaN"))
+            & ~Q(chi_squared=Decimal("NaN"))
+            & ~Q(period_length=Decimal("NaN"))
         )
 
     @property
@@ -382,20 +780,23 @@ class FoldedLightcurve(models.Model, ImageGenerator):
             zoo_thumbnail = self.zooniversesubject.thumbnail_location
         except ZooniverseSubject.DoesNotExist:
             zoo_thumbnail = None
-        return self.get_or_generate_image(
-            self.thumbnail_file,
-            generate_lightcurve_images,
-            zoo_thumbnail,
-        )
+        return self.get_image_url(self.thumbnail_file, zoo_thumbnail)
 
-    @property
-    def timeseries(self):
-        if not self.star.timeseries:
-            return
+    def fold(self, cycles=2, photometry=None):
+        """
+        Returns (phase, flux) for the star's photometry folded at this period.
+        """
         if not self.period_length or math.isnan(self.period_length):
             return
-        return self.star.timeseries.fold(
-            period=self.period_length * units.second,
+        if photometry is None:
+            photometry = self.star.photometry
+        if not photometry:
+            return
+        return fold(
+            photometry.hjd,
+            photometry.clipped_flux,
+            self.period_length / SECONDS_PER_DAY,
+            cycles=cycles,
         )
 
 
@@ -453,11 +854,19 @@ def get_next_data_release_version():
 class DataRelease(models.Model):
     version = models.FloatField(default=get_next_data_release_version)
     generate_export = models.BooleanField(default=False)
+    # Incremental releases only aggregate subjects with new classifications, and
+    # copy everything else from the previous release
+    incremental = models.BooleanField(default=False)
+    base_release = models.ForeignKey(
+        "self", null=True, blank=True, on_delete=models.SET_NULL, editable=False
+    )
+    last_classification_id = models.BigIntegerField(null=True, editable=False)
 
     active = models.BooleanField(default=False)
 
     created = models.DateTimeField(auto_now_add=True)
     aggregation_finished = models.DateTimeField(null=True)
+    progress = models.FloatField(default=0.0)
     active_at = models.DateTimeField(null=True, blank=True)
 
     @classmethod
@@ -468,9 +877,30 @@ class DataRelease(models.Model):
         result = result.order_by("-version")
         return result.first()
 
+    def get_incremental_base(self):
+        """
+        Returns the latest finished release which an incremental release can be
+        built on, or None.
+        """
+        return (
+            DataRelease.objects.exclude(id=self.id)
+            .filter(aggregation_finished__isnull=False)
+            .filter(last_classification_id__isnull=False)
+            .order_by("-version")
+            .first()
+        )
+
     @property
     def full_export(self):
-        return self.dataexport_set.filter(in_data_archive=True).first()
+        return self.dataexport_set.filter(
+            in_data_archive=True, export_format=DataExport.FORMAT_CSV
+        ).first()
+
+    @property
+    def full_fits_export(self):
+        return self.dataexport_set.filter(
+            in_data_archive=True, export_format=DataExport.FORMAT_FITS
+        ).first()
 
     def pending_stars(self):
         return (
@@ -523,10 +953,267 @@ class AggregatedClassification(models.Model):
     def get_latest(cls, active=True):
         return cls.objects.filter(data_release=DataRelease.get_latest(active=active))
 
+    @classmethod
+    def get_visible(cls, data_release):
+        return cls.objects.filter(data_release=data_release).filter(
+            ~Q(lightcurve__sigma=Decimal("NaN"))
+            & ~Q(lightcurve__chi_squared=Decimal("NaN"))
+            & ~Q(lightcurve__period_length=Decimal("NaN"))
+        )
+
+
+class CatalogueEntry(models.Model, SuperWASPCoordinates):
+    """
+    A flattened copy of a visible AggregatedClassification, along with the
+    lightcurve and star it belongs to. Searching and sorting the catalogue uses
+    this table so that it doesn't need to join across all of them.
+    """
+
+    BUILD_CHUNK_SIZE = 5000
+    # Maps fields on this model to the AggregatedClassification fields they're
+    # copied from
+    SOURCE_FIELDS = {
+        "aggregated_classification_id": "id",
+        "data_release_id": "data_release_id",
+        "lightcurve_id": "lightcurve_id",
+        "star_id": "lightcurve__star_id",
+        "superwasp_id": "lightcurve__star__superwasp_id",
+        "period_length": "lightcurve__period_length",
+        "sigma": "lightcurve__sigma",
+        "chi_squared": "lightcurve__chi_squared",
+        "classification": "classification",
+        "period_uncertainty": "period_uncertainty",
+        "classification_count": "classification_count",
+        "mean_magnitude": "lightcurve__star___mean_magnitude",
+        "min_magnitude": "lightcurve__star___min_magnitude",
+        "max_magnitude": "lightcurve__star___max_magnitude",
+        "amplitude": "lightcurve__star___amplitude",
+        "location": "lightcurve__star__location",
+    }
+
+    data_release = models.ForeignKey(DataRelease, on_delete=models.CASCADE)
+    aggregated_classification = models.OneToOneField(
+        AggregatedClassification, on_delete=models.CASCADE
+    )
+    lightcurve = models.ForeignKey(FoldedLightcurve, on_delete=models.CASCADE)
+    star = models.ForeignKey(Star, on_delete=models.CASCADE)
+
+    superwasp_id = models.CharField(max_length=26)
+    period_length = models.FloatField(null=True)
+    sigma = models.FloatField(null=True)
+    chi_squared = models.FloatField(null=True)
+
+    classification = models.IntegerField(
+        choices=AggregatedClassification.CLASSIFICATION_CHOICES
+    )
+    period_uncertainty = models.IntegerField(
+        choices=AggregatedClassification.PERIOD_UNCERTAINTY_CHOICES
+    )
+    classification_count = models.IntegerField()
+
+    mean_magnitude = models.FloatField(null=True)
+    min_magnitude = models.FloatField(null=True)
+    max_magnitude = models.FloatField(null=True)
+    amplitude = models.FloatField(null=True)
+
+    location = SPointField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["data_release", "superwasp_id"]),
+            models.Index(fields=["data_release", "period_length"]),
+            models.Index(fields=["data_release", "classification"]),
+            models.Index(fields=["data_release", "classification_count"]),
+            models.Index(fields=["data_release", "mean_magnitude"]),
+            models.Index(fields=["data_release", "amplitude"]),
+            SPointIndex(fields=["location"], name="catalogue_location_spoint"),
+        ]
+
+    def __str__(self):
+        return f"{self.superwasp_id}@{self.period_length} sec ({self.data_release})"
+
+    @property
+    def natural_period(self):
+        return naturaldelta(self.period_length)
+
+    @classmethod
+    def build(cls, data_release):
+        """
+        (Re)builds the catalogue entries for a data release.
+        """
+        rows = (
+            AggregatedClassification.get_visible(data_release)
+            .values_list(*cls.SOURCE_FIELDS.values())
+            .iterator(chunk_size=cls.BUILD_CHUNK_SIZE)
+        )
+        with transaction.atomic():
+            cls.objects.filter(data_release=data_release).delete()
+            while True:
+                chunk = list(itertools.islice(rows, cls.BUILD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                cls.objects.bulk_create(
+                    [cls(**dict(zip(cls.SOURCE_FIELDS.keys(), row))) for row in chunk]
+                )
+
+    @classmethod
+    def update_star(cls, star):
+        """
+        Copies a star's stats and location into its catalogue entries.
+        """
+        cls.objects.filter(star=star).update(
+            mean_magnitude=star._mean_magnitude,
+            min_magnitude=star._min_magnitude,
+            max_magnitude=star._max_magnitude,
+            amplitude=star._amplitude,
+            location=star.location,
+        )
+
+    @classmethod
+    def copy_star_fields(cls, star_ids, fields):
+        """
+        Copies fields from the given stars into their catalogue entries with a single
+        UPDATE. fields maps catalogue entry fields to the star fields they come from.
+        """
+        cls.objects.filter(star_id__in=star_ids).update(
+            **{
+                field: Subquery(
+                    Star.objects.filter(id=OuterRef("star_id")).values(star_field)
+                )
+                for field, star_field in fields.items()
+            }
+        )
+
+    @classmethod
+    def update_locations(cls, star_ids):
+        """
+        Copies the locations of the given stars into their catalogue entries.
+        """
+        cls.copy_star_fields(star_ids, {"location": "location"})
+
+    @classmethod
+    def update_magnitudes(cls, star_ids):
+        """
+        Copies the magnitudes of the given stars into their catalogue entries.
+        """
+        cls.copy_star_fields(
+            star_ids,
+            {
+                "mean_magnitude": "_mean_magnitude",
+                "min_magnitude": "_min_magnitude",
+                "max_magnitude": "_max_magnitude",
+                "amplitude": "_amplitude",
+            },
+        )
+
+
+class StagedFile(File):
+    """
+    A file on local disk which the storage can move into place instead of copying.
+    """
+
+    def temporary_file_path(self):
+        return self.name
+
+
+class StagedFITSFile(models.Model):
+    """
+    A FITS file which was fetched outside of the app and left in a batch directory
+    under MEDIA_ROOT/missing to be ingested. Indexing these means a download can look
+    its star up instead of searching every batch directory.
+    """
+
+    superwasp_id = models.CharField(unique=True, max_length=26)
+    batch = models.CharField(max_length=255, db_index=True)
+
+    def __str__(self):
+        return f"{self.batch}/{self.superwasp_id}.fits"
+
+    @staticmethod
+    def get_staging_root():
+        return Path(settings.MEDIA_ROOT) / "missing"
+
+    @property
+    def path(self):
+        return self.get_staging_root() / self.batch / f"{self.superwasp_id}.fits"
+
+    @classmethod
+    def update_index(cls, rescan=False):
+        """
+        Indexes the files in batch directories which haven't been seen before. With
+        rescan, every batch directory is listed again and anything which has been
+        removed is dropped from the index. Returns the number of files added.
+        """
+        indexed_batches = set(cls.objects.values_list("batch", flat=True).distinct())
+        batch_dirs = [
+            batch_dir
+            for batch_dir in sorted(cls.get_staging_root().glob("batch_*"))
+            if batch_dir.is_dir()
+        ]
+        if rescan:
+            cls.objects.exclude(
+                batch__in=[batch_dir.name for batch_dir in batch_dirs]
+            ).delete()
+
+        added = 0
+        for batch_dir in batch_dirs:
+            if batch_dir.name in indexed_batches and not rescan:
+                continue
+            with os.scandir(batch_dir) as entries:
+                superwasp_ids = {
+                    entry.name.removesuffix(".fits")
+                    for entry in entries
+                    if entry.name.endswith(".fits") and entry.is_file()
+                }
+            indexed = set(
+                cls.objects.filter(batch=batch_dir.name).values_list(
+                    "superwasp_id", flat=True
+                )
+            )
+            new_ids = superwasp_ids - indexed
+            # A star staged in more than one batch keeps its first file
+            new_ids -= set(
+                cls.objects.filter(superwasp_id__in=new_ids).values_list(
+                    "superwasp_id", flat=True
+                )
+            )
+            with transaction.atomic():
+                cls.objects.filter(
+                    batch=batch_dir.name, superwasp_id__in=indexed - superwasp_ids
+                ).delete()
+                cls.objects.bulk_create(
+                    [
+                        cls(superwasp_id=superwasp_id, batch=batch_dir.name)
+                        for superwasp_id in sorted(new_ids)
+                    ],
+                    batch_size=5000,
+                    ignore_conflicts=True,
+                )
+            added += len(new_ids)
+        return added
+
+    def ingest(self, star):
+        """
+        Moves the staged file into place as the star's FITS file. Returns False if
+        the file has been removed since it was indexed.
+        """
+        try:
+            fits_f = open(self.path, "rb")
+        except FileNotFoundError:
+            self.delete()
+            return False
+        with fits_f:
+            star.save_fits(StagedFile(fits_f))
+        # Storage which can't move the file will have copied it instead
+        self.path.unlink(missing_ok=True)
+        self.delete()
+        return True
+
 
 from .tasks import (
     download_fits,
     generate_lightcurve_images,
+    generate_star_lightcurve_images,
     generate_star_images,
     generate_star_json_files,
     save_zooniverse_metadata,
@@ -0,0 +1,106 @@
+import os
+
+import astropy.io.fits as fits
+import numpy
+
+from astropy.stats import sigma_clip
+
+
+# Rows of the array stored in a photometry file
+PHOTOMETRY_HJD = 0
+PHOTOMETRY_FLUX = 1
+PHOTOMETRY_OUTLIER = 2
+
+OUTLIER_SIGMA_CLIP = 5
+FLUX_MAX_CLIP = 2e5
+
+# SuperWASP FITS files give times in seconds since this HJD
+FITS_TIME_ZERO_HJD = 2453005.5
+SECONDS_PER_DAY = 86400
+
+
+def clip_outliers(flux):
+    return sigma_clip(
+        numpy.ma.masked_greater(
+            numpy.ma.masked_less(
+                flux,
+                -FLUX_MAX_CLIP,
+            ),
+            FLUX_MAX_CLIP,
+        ),
+        sigma=OUTLIER_SIGMA_CLIP,
+    )
+
+
+class Photometry(object):
+    """
+    HJD and outlier-clipped flux for one star.
+
+    This is stored as a single .npy file holding a (3, n) float64 array: HJD, flux
+    and an outlier flag for each observation. Each row is contiguous, so the file
+    can be memory mapped and the columns used without copying.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    @classmethod
+    def from_arrays(cls, hjd, clipped_flux):
+        """
+        Builds photometry from an array of HJDs and a masked array of fluxes.
+        """
+        data = numpy.empty((3, len(hjd)), dtype=numpy.float64)
+        data[PHOTOMETRY_HJD] = hjd
+        data[PHOTOMETRY_FLUX] = numpy.ma.getdata(clipped_flux)
+        data[PHOTOMETRY_OUTLIER] = numpy.ma.getmaskarray(clipped_flux)
+        return cls(data)
+
+    @classmethod
+    def from_fits(cls, fits_path):
+        """
+        Reads the photometry from a SuperWASP FITS file, clipping the outliers.
+
+        This doesn't touch the database, so it can run in a pool of processes.
+        """
+        with fits.open(fits_path) as fits_file:
+            data = fits_file[1].data
+            hjd = data["TMID"] / SECONDS_PER_DAY + FITS_TIME_ZERO_HJD
+            flux = clip_outliers(numpy.asarray(data["TAMFLUX2"], dtype=numpy.float64))
+        return cls.from_arrays(hjd, flux)
+
+    @classmethod
+    def load(cls, photometry_file):
+        return cls(numpy.load(photometry_file, mmap_mode="r"))
+
+    def save(self, photometry_file):
+        numpy.save(photometry_file, self.data, allow_pickle=False)
+
+    def write(self, path):
+        """
+        Saves to the file at path, replacing any existing file in one step so that
+        readers never see it half written.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as photometry_file:
+            self.save(photometry_file)
+        os.replace(temp_path, path)
+
+    @property
+    def hjd(self):
+        return self.data[PHOTOMETRY_HJD]
+
+    @property
+    def flux(self):
+        return self.data[PHOTOMETRY_FLUX]
+
+    @property
+    def mask(self):
+        return self.data[PHOTOMETRY_OUTLIER] != 0
+
+    @property
+    def clipped_flux(self):
+        return numpy.ma.MaskedArray(self.flux, mask=self.mask, copy=False)
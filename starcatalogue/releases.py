@@ -0,0 +1,547 @@
+import logging
+
+import numpy
+import pandas
+import ujson as json
+
+from django.db import transaction
+from pandas.api.types import union_categoricals
+
+from .models import (
+    AggregatedClassification,
+    DataRelease,
+    FoldedLightcurve,
+    Star,
+    ZooniverseSubject,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Number of subjects whose records are written in each transaction
+RELEASE_CHUNK_SIZE = 5000
+# A release's progress once its classifications are written, leaving the rest for
+# building its catalogue
+CLASSIFICATIONS_PROGRESS = 90.0
+
+# Number of rows of the classification export parsed at a time
+EXPORT_CHUNK_SIZE = 100000
+EXPORT_COLUMNS = [
+    "classification_id",
+    "user_name",
+    "workflow_id",
+    "subject_ids",
+    "annotations",
+]
+
+PERIOD_CERTAINTY_OVERRIDES = {
+    "Rotator": "Correct period",
+    "Unknown": "Correct period",
+    "Junk": "Wrong period",
+}
+
+# The ordering of these matters for tie breaking
+CLASSIFICATION_COLUMNS = [
+    "Junk",
+    "Pulsator",
+    "Rotator",
+    "EW type",
+    "EA/EB type",
+    "Unknown",
+]
+
+# The ordering of these matters for tie breaking
+PERIOD_CERTAINTIES = ["Half correct period", "Correct period", "Wrong period"]
+
+CLASSIFICATION_LOOKUP = {
+    "EA/EB type": AggregatedClassification.EA_EB,
+    "EW type": AggregatedClassification.EW,
+    "Pulsator": AggregatedClassification.PULSATOR,
+    "Rotator": AggregatedClassification.ROTATOR,
+    "Unknown": AggregatedClassification.UNKNOWN,
+    "Wrong period": AggregatedClassification.UNCERTAIN,
+    "Correct period": AggregatedClassification.CERTAIN,
+    "Half correct period": AggregatedClassification.HALF,
+}
+
+# Maps the columns of the aggregated classifications to the names used here
+RELEASE_COLUMNS = {
+    "SWASP ID": "superwasp_id",
+    "Period Number": "period_number",
+    "Original Period": "period_length",
+    "Sigma": "sigma",
+    "Chi Squared": "chi_squared",
+}
+
+
+def parse_export_chunk(chunk, workflow_ids):
+    """
+    Parses a chunk of rows from the classification export into a frame of
+    classification_id, subject_id, classification, period_certainty and user_name.
+    """
+    chunk = chunk[chunk["workflow_id"].isin(workflow_ids)]
+    annotations = [json.loads(row) for row in chunk["annotations"]]
+    classification = pandas.Series(
+        [annotation[0]["value"] for annotation in annotations],
+        index=chunk.index,
+        dtype=object,
+    )
+    period_certainty = pandas.Series(
+        [
+            annotation[1]["value"] if len(annotation) > 1 else None
+            for annotation in annotations
+        ],
+        index=chunk.index,
+        dtype=object,
+    )
+    # Prepend primary classification to period certainty vote so we can count votes
+    # for each primary class separately
+    period_certainty = classification.map(PERIOD_CERTAINTY_OVERRIDES).fillna(
+        period_certainty.fillna("None")
+    )
+    parsed = pandas.DataFrame(
+        {
+            "classification_id": chunk["classification_id"].astype(numpy.int64),
+            "subject_id": chunk["subject_ids"].astype(numpy.int32),
+            "classification": classification,
+            "period_certainty": classification + " " + period_certainty.astype(str),
+            "user_name": chunk["user_name"],
+        }
+    )
+    # We don't need these as they are subsequently classified in the main workflow
+    return parsed[parsed["classification"] != "Real"]
+
+
+def read_classification_export(
+    export_file,
+    workflow_ids,
+    chunk_size=EXPORT_CHUNK_SIZE,
+    after_classification_id=None,
+):
+    """
+    Reads the classifications from a Zooniverse classification export, parsing
+    chunk_size rows at a time so that the whole export is never held in memory.
+    If after_classification_id is given, older classifications are skipped before
+    their annotations are parsed.
+
+    Only the columns needed for aggregation are kept, with the classification IDs as
+    int64, subject IDs as int32 and the other columns categorical. Repeat
+    classifications of a subject by the same user are dropped as each chunk is read,
+    keeping the first, using a sorted array of (user, subject) keys rather than the
+    strings themselves.
+    """
+    user_codes = {}
+    seen_keys = numpy.empty(0, dtype=numpy.int64)
+    chunks = []
+    for chunk in pandas.read_csv(
+        export_file,
+        usecols=EXPORT_COLUMNS,
+        dtype={"user_name": str, "annotations": str},
+        chunksize=chunk_size,
+    ):
+        if after_classification_id is not None:
+            chunk = chunk[chunk["classification_id"] > after_classification_id]
+        parsed = parse_export_chunk(chunk, workflow_ids)
+        user_code = numpy.array(
+            [
+                user_codes.setdefault(user_name, len(user_codes))
+                for user_name in parsed["user_name"]
+            ],
+            dtype=numpy.int64,
+        )
+        keys = (user_code << 32) | parsed["subject_id"].to_numpy(dtype=numpy.int64)
+        _, first = numpy.unique(keys, return_index=True)
+        first = numpy.sort(first)
+        keys = keys[first]
+        if len(seen_keys):
+            positions = numpy.searchsorted(seen_keys, keys)
+            new = seen_keys[positions.clip(max=len(seen_keys) - 1)] != keys
+        else:
+            new = numpy.ones(len(keys), dtype=bool)
+        keep = first[new]
+        if not len(keep):
+            continue
+        # A stable sort merges the two sorted runs in linear time
+        seen_keys = numpy.sort(
+            numpy.concatenate((seen_keys, numpy.sort(keys[new]))), kind="stable"
+        )
+        chunks.append(
+            pandas.DataFrame(
+                {
+                    "classification_id": parsed["classification_id"].to_numpy()[keep],
+                    "subject_id": parsed["subject_id"].to_numpy()[keep],
+                    "classification": pandas.Categorical(
+                        parsed["classification"].to_numpy()[keep]
+                    ),
+                    "period_certainty": pandas.Categorical(
+                        parsed["period_certainty"].to_numpy()[keep]
+                    ),
+                    "user_code": user_code[keep].astype(numpy.int32),
+                }
+            )
+        )
+
+    if not chunks:
+        return pandas.DataFrame(
+            {
+                "classification_id": pandas.Series(dtype=numpy.int64),
+                "subject_id": pandas.Series(dtype=numpy.int32),
+                "classification": pandas.Categorical([]),
+                "period_certainty": pandas.Categorical([]),
+                "user_name": pandas.Categorical([]),
+            }
+        )
+    return pandas.DataFrame(
+        {
+            "classification_id": numpy.concatenate(
+                [chunk["classification_id"].to_numpy() for chunk in chunks]
+            ),
+            "subject_id": numpy.concatenate(
+                [chunk["subject_id"].to_numpy() for chunk in chunks]
+            ),
+            "classification": union_categoricals(
+                [chunk["classification"] for chunk in chunks]
+            ),
+            "period_certainty": union_categoricals(
+                [chunk["period_certainty"] for chunk in chunks]
+            ),
+            "user_name": pandas.Categorical.from_codes(
+                numpy.concatenate([chunk["user_code"].to_numpy() for chunk in chunks]),
+                categories=list(user_codes),
+            ),
+        }
+    )
+
+
+def count_votes(classifications, column):
+    """
+    Counts the classifications of each subject with each value of column. Returns a
+    frame indexed by subject ID with a column for each value.
+    """
+    return (
+        classifications.groupby(["subject_id", column], observed=True)
+        .size()
+        .unstack(fill_value=0)
+    )
+
+
+def aggregate_votes(classifications):
+    """
+    Works out each subject's consensus class, period certainty and classification
+    count from a frame of individual classifications, using whole-frame operations
+    rather than looking at each subject in turn.
+
+    Each period certainty in classifications is prefixed by the classification it
+    was given with, so that the votes for each class are counted separately.
+    Returns a frame indexed by subject ID with the votes for each class and
+    "consensus class", "period certainty" and "classification count" columns.
+    Subjects whose consensus is junk are left out.
+    """
+    class_votes = count_votes(classifications, "classification").reindex(
+        columns=CLASSIFICATION_COLUMNS, fill_value=0
+    )
+    # argmax picks the first of any tied columns
+    consensus = numpy.array(CLASSIFICATION_COLUMNS)[
+        class_votes.to_numpy().argmax(axis=1)
+    ]
+
+    # Gather the votes for each subject's consensus class into one array
+    certainty_votes = count_votes(classifications, "period_certainty").reindex(
+        class_votes.index, fill_value=0
+    )
+    votes = numpy.zeros((len(class_votes), len(PERIOD_CERTAINTIES)), dtype=numpy.intp)
+    for classification in CLASSIFICATION_COLUMNS:
+        rows = consensus == classification
+        for i, certainty in enumerate(PERIOD_CERTAINTIES):
+            column = f"{classification} {certainty}"
+            if column in certainty_votes:
+                votes[rows, i] = certainty_votes[column].to_numpy()[rows]
+    # Pulsators can't have a half correct period
+    votes[consensus == "Pulsator", PERIOD_CERTAINTIES.index("Half correct period")] = -1
+    period_certainty = pandas.Series(
+        numpy.array(PERIOD_CERTAINTIES)[votes.argmax(axis=1)], index=class_votes.index
+    )
+    consensus = pandas.Series(consensus, index=class_votes.index)
+    period_certainty = consensus.map(PERIOD_CERTAINTY_OVERRIDES).fillna(
+        period_certainty
+    )
+
+    aggregated_classifications = class_votes.assign(
+        **{
+            "consensus class": consensus,
+            "period certainty": period_certainty,
+            "classification count": class_votes.sum(axis="columns"),
+        }
+    )
+    return aggregated_classifications[consensus != "Junk"]
+
+
+def get_or_create_stars(superwasp_ids):
+    """
+    Returns a dict mapping each SuperWASP ID to its star's ID, creating any stars
+    which don't exist yet.
+    """
+    star_ids = dict(
+        Star.objects.filter(superwasp_id__in=superwasp_ids).values_list(
+            "superwasp_id", "id"
+        )
+    )
+    new_ids = [
+        superwasp_id for superwasp_id in superwasp_ids if superwasp_id not in star_ids
+    ]
+    if new_ids:
+        Star.objects.bulk_create(
+            [Star(superwasp_id=superwasp_id) for superwasp_id in new_ids],
+            ignore_conflicts=True,
+        )
+        star_ids.update(
+            Star.objects.filter(superwasp_id__in=new_ids).values_list(
+                "superwasp_id", "id"
+            )
+        )
+    return star_ids
+
+
+def import_chunk(data_release, chunk):
+    """
+    Writes the records for one chunk of subjects, with a few bulk queries rather
+    than several for each subject.
+    """
+    star_ids = get_or_create_stars(chunk["superwasp_id"].unique().tolist())
+    chunk = chunk.assign(star_id=chunk["superwasp_id"].map(star_ids))
+
+    # Subjects from earlier releases already know which lightcurve they show
+    subject_lightcurves = dict(
+        ZooniverseSubject.objects.filter(
+            zooniverse_id__in=chunk.index.tolist()
+        ).values_list("zooniverse_id", "lightcurve_id")
+    )
+    lightcurve_ids = chunk.index.to_series().map(subject_lightcurves)
+    new_subjects = lightcurve_ids.isna()
+
+    # Because of earlier data issues there can be duplicate lightcurves, but it is
+    # safe to just use the first one and ignore the others
+    existing_lightcurves = {}
+    for star_id, period_number, lightcurve_id in (
+        FoldedLightcurve.objects.filter(
+            star_id__in=chunk.loc[new_subjects, "star_id"].unique().tolist()
+        )
+        .order_by("id")
+        .values_list("star_id", "period_number", "id")
+    ):
+        existing_lightcurves.setdefault((star_id, period_number), lightcurve_id)
+    lightcurve_keys = pandas.Series(
+        list(zip(chunk["star_id"], chunk["period_number"])), index=chunk.index
+    )
+    lightcurve_ids[new_subjects] = lightcurve_keys[new_subjects].map(
+        existing_lightcurves
+    )
+
+    # Lightcurves which exist get any corrected metadata staged, to be applied when
+    # the release is activated
+    existing = chunk[lightcurve_ids.notna()].assign(
+        lightcurve_id=lightcurve_ids.dropna().astype(int)
+    )
+    current = pandas.DataFrame.from_records(
+        FoldedLightcurve.objects.filter(
+            id__in=existing["lightcurve_id"].unique().tolist()
+        ).values_list("id", "period_length", "sigma", "chi_squared"),
+        columns=["lightcurve_id", "period_length", "sigma", "chi_squared"],
+    ).set_index("lightcurve_id")
+    current = current.reindex(existing["lightcurve_id"])
+    changed = existing[
+        (current["period_length"].values != existing["period_length"].values)
+        | (current["sigma"].values != existing["sigma"].values)
+        | (current["chi_squared"].values != existing["chi_squared"].values)
+    ].drop_duplicates(subset="lightcurve_id", keep="last")
+    FoldedLightcurve.objects.bulk_update(
+        [
+            FoldedLightcurve(
+                id=row.lightcurve_id,
+                updated_period_length=row.period_length,
+                updated_sigma=row.sigma,
+                updated_chi_squared=row.chi_squared,
+            )
+            for row in changed.itertuples()
+        ],
+        ["updated_period_length", "updated_sigma", "updated_chi_squared"],
+        batch_size=1000,
+    )
+
+    # Subjects sharing a new lightcurve all use the one created for the first
+    missing = lightcurve_ids.isna()
+    new_lightcurves = (
+        chunk[missing]
+        .assign(key=lightcurve_keys[missing])
+        .drop_duplicates(subset="key", keep="first")
+    )
+    created = FoldedLightcurve.objects.bulk_create(
+        [
+            FoldedLightcurve(
+                star_id=row.star_id,
+                period_number=row.period_number,
+                period_length=row.period_length,
+                sigma=row.sigma,
+                chi_squared=row.chi_squared,
+            )
+            for row in new_lightcurves.itertuples()
+        ],
+        batch_size=1000,
+    )
+    lightcurve_ids[missing] = lightcurve_keys[missing].map(
+        {
+            key: lightcurve.id
+            for key, lightcurve in zip(new_lightcurves["key"], created)
+        }
+    )
+    lightcurve_ids = lightcurve_ids.astype(int)
+
+    ZooniverseSubject.objects.bulk_create(
+        [
+            ZooniverseSubject(zooniverse_id=subject_id, lightcurve_id=lightcurve_id)
+            for subject_id, lightcurve_id in lightcurve_ids[new_subjects].items()
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+    AggregatedClassification.objects.bulk_create(
+        [
+            AggregatedClassification(
+                data_release=data_release,
+                lightcurve_id=lightcurve_id,
+                classification=row.classification,
+                period_uncertainty=row.period_uncertainty,
+                classification_count=row.classification_count,
+            )
+            for lightcurve_id, row in zip(lightcurve_ids.tolist(), chunk.itertuples())
+        ],
+        batch_size=1000,
+    )
+
+
+def update_progress(data_release, done, total, progress_range):
+    """
+    Sets the release's progress to the fraction done / total of progress_range, a
+    (start, end) tuple of percentages.
+    """
+    start, end = progress_range
+    DataRelease.objects.filter(id=data_release.id).update(
+        progress=start + (end - start) * (done / total if total else 1)
+    )
+
+
+def import_aggregated_classifications(
+    data_release,
+    aggregated_classifications,
+    chunk_size=RELEASE_CHUNK_SIZE,
+    progress_range=(0, 100),
+):
+    """
+    Creates the stars, lightcurves, Zooniverse subjects and aggregated
+    classifications for a data release. aggregated_classifications comes from
+    aggregate_votes, joined with each subject's lightcurve metadata.
+
+    The subjects are written chunk_size at a time, each chunk in its own
+    transaction, and the release's progress is moved through progress_range after
+    each chunk.
+    """
+    rows = aggregated_classifications.rename(columns=RELEASE_COLUMNS)
+    unknown = rows["superwasp_id"].isna()
+    if unknown.any():
+        logger.warning(
+            f"Skipping {unknown.sum()} subjects which aren't in the lookup table"
+        )
+        rows = rows[~unknown]
+    rows = rows.assign(
+        period_number=rows["period_number"].astype(int),
+        classification=rows["consensus class"].map(CLASSIFICATION_LOOKUP),
+        period_uncertainty=rows["period certainty"].map(CLASSIFICATION_LOOKUP),
+        classification_count=rows["classification count"],
+    )[
+        list(RELEASE_COLUMNS.values())
+        + ["classification", "period_uncertainty", "classification_count"]
+    ]
+
+    total = len(rows)
+    for start in range(0, total, chunk_size):
+        with transaction.atomic():
+            import_chunk(data_release, rows.iloc[start : start + chunk_size])
+        update_progress(
+            data_release, min(start + chunk_size, total), total, progress_range
+        )
+
+
+def get_changed_subjects(classifications, last_classification_id):
+    """
+    Returns the IDs of the subjects which have classifications newer than
+    last_classification_id.
+    """
+    return classifications.loc[
+        classifications["classification_id"] > last_classification_id, "subject_id"
+    ].unique()
+
+
+def carry_forward_classifications(
+    base_release,
+    data_release,
+    changed_subject_ids,
+    chunk_size=RELEASE_CHUNK_SIZE,
+    progress_range=(0, 100),
+):
+    """
+    Copies base_release's aggregated classifications into data_release, except for
+    the subjects in changed_subject_ids which have been aggregated again. Returns the
+    number of classifications copied.
+
+    Like import_aggregated_classifications, each chunk is copied in its own
+    transaction and the release's progress is moved through progress_range.
+    """
+    changed_subject_ids = set(changed_subject_ids.tolist())
+    base_classifications = AggregatedClassification.objects.filter(
+        data_release=base_release
+    ).order_by("id")
+    total = base_classifications.count()
+    done = 0
+    copied = 0
+    last_id = 0
+    while True:
+        chunk = list(
+            base_classifications.filter(id__gt=last_id).values_list(
+                "id",
+                "lightcurve__zooniversesubject__zooniverse_id",
+                "lightcurve_id",
+                "classification",
+                "period_uncertainty",
+                "classification_count",
+            )[:chunk_size]
+        )
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+        with transaction.atomic():
+            created = AggregatedClassification.objects.bulk_create(
+                [
+                    AggregatedClassification(
+                        data_release=data_release,
+                        lightcurve_id=lightcurve_id,
+                        classification=classification,
+                        period_uncertainty=period_uncertainty,
+                        classification_count=classification_count,
+                    )
+                    for (
+                        _,
+                        subject_id,
+                        lightcurve_id,
+                        classification,
+                        period_uncertainty,
+                        classification_count,
+                    ) in chunk
+                    if subject_id not in changed_subject_ids
+                ],
+                batch_size=1000,
+            )
+        copied += len(created)
+        done += len(chunk)
+        update_progress(data_release, done, total, progress_range)
+    return copied
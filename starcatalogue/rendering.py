@@ -0,0 +1,119 @@
+import functools
+import io
+
+import numpy
+
+from django.conf import settings
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+
+IMAGE_SIZE = (6.4, 4.8)
+IMAGE_DPI = 100
+THUMBNAIL_SIZE = (100, 60)
+# Faster than the default level, for PNGs only a little larger
+PNG_COMPRESS_LEVEL = 3
+DENSITY_COLORMAP = "Blues"
+
+
+class LightcurveRenderer(object):
+    """
+    Draws lightcurve scatter plots onto one Agg canvas which is reused for every
+    image, producing the PNG and its thumbnail from the same render.
+
+    Lightcurves with more than density_threshold points are drawn as a 2D histogram
+    instead, binned at the resolution of the plot. That takes about the same time
+    however many points there are, and shows where the points are concentrated
+    rather than one solid blob.
+    """
+
+    def __init__(self, size=IMAGE_SIZE, dpi=IMAGE_DPI, density_threshold=None):
+        self.density_threshold = density_threshold
+        self.figure = Figure(figsize=size, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        # Otherwise the density image's edges would stop the margins being added
+        self.axes.use_sticky_edges = False
+        self.points = self.axes.scatter(
+            [], [], s=1, alpha=0.5, linewidths=0, rasterized=True
+        )
+        self.density = self.axes.imshow(
+            numpy.ma.masked_all((1, 1)),
+            origin="lower",
+            aspect="auto",
+            interpolation="nearest",
+            cmap=DENSITY_COLORMAP,
+            visible=False,
+        )
+
+    def render(self, x, y, title, xlabel, ylabel="flux"):
+        """
+        Plots y (which may be a masked array) against x. Returns a tuple of the PNG
+        image and thumbnail as bytes.
+        """
+        mask = numpy.ma.getmaskarray(y)
+        points = numpy.column_stack(
+            (numpy.asarray(x)[~mask], numpy.ma.getdata(y)[~mask])
+        )
+        self.axes.ignore_existing_data_limits = True
+        self.axes.update_datalim(points)
+        self.axes.autoscale_view()
+        use_density = (
+            self.density_threshold is not None and len(points) > self.density_threshold
+        )
+        if use_density:
+            self.draw_density(points)
+            self.points.set_offsets(numpy.empty((0, 2)))
+        else:
+            self.points.set_offsets(points)
+        self.density.set_visible(use_density)
+        self.points.set_visible(not use_density)
+        self.axes.set_title(title)
+        self.axes.set_xlabel(xlabel)
+        self.axes.set_ylabel(ylabel)
+        return self.save()
+
+    def draw_density(self, points):
+        """
+        Bins the points into one cell per pixel of the axes and shows the log of
+        the counts. Empty cells are left transparent.
+        """
+        (x0, x1), (y0, y1) = self.axes.get_xlim(), self.axes.get_ylim()
+        bbox = self.axes.get_window_extent()
+        width, height = max(int(bbox.width), 1), max(int(bbox.height), 1)
+        x_bins = numpy.clip(
+            ((points[:, 0] - x0) * (width / (x1 - x0))).astype(numpy.intp), 0, width - 1
+        )
+        y_bins = numpy.clip(
+            ((points[:, 1] - y0) * (height / (y1 - y0))).astype(numpy.intp),
+            0,
+            height - 1,
+        )
+        counts = numpy.bincount(y_bins * width + x_bins, minlength=width * height)
+        counts = numpy.log1p(counts.reshape(height, width))
+        self.density.set_data(numpy.ma.masked_equal(counts, 0))
+        self.density.set_extent((x0, x1, y0, y1))
+        self.density.set_clim(0, max(counts.max(), 1))
+
+    def save(self):
+        self.canvas.draw()
+        # The figure is opaque, so the alpha channel is dropped before encoding
+        image = Image.frombuffer(
+            "RGBA", self.canvas.get_width_height(), self.canvas.buffer_rgba()
+        ).convert("RGB")
+        image_data = io.BytesIO()
+        image.save(image_data, format="png", compress_level=PNG_COMPRESS_LEVEL)
+        image.thumbnail(THUMBNAIL_SIZE)
+        thumbnail_data = io.BytesIO()
+        image.save(thumbnail_data, format="png", compress_level=PNG_COMPRESS_LEVEL)
+        return image_data.getvalue(), thumbnail_data.getvalue()
+
+
+@functools.cache
+def get_renderer():
+    """
+    Returns this process's renderer, so the figure is only set up once per worker.
+    """
+    return LightcurveRenderer(density_threshold=settings.DENSITY_RENDER_THRESHOLD)
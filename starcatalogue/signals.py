@@ -1,8 +1,9 @@
 from celery.result import AsyncResult
 
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 
+from starcatalogue.caching import invalidate_results_cache
 from starcatalogue.exports import DataExport
 from starcatalogue.models import DataRelease
 from starcatalogue.tasks import (
@@ -18,6 +19,22 @@ def queue_prepare_data_release(sender, instance, created, **kwargs):
         prepare_data_release.delay(instance.id)
 
 
+@receiver(pre_save, sender=DataRelease)
+def record_data_release_activation(sender, instance, **kwargs):
+    instance._saved_activation = (
+        DataRelease.objects.filter(pk=instance.pk)
+        .values_list("active", "active_at")
+        .first()
+    ) or (False, None)
+
+
+@receiver(post_save, sender=DataRelease)
+def invalidate_data_release_results(sender, instance, created, **kwargs):
+    # Progress updates and the like don't change which results are shown
+    if instance._saved_activation != (instance.active, instance.active_at):
+        invalidate_results_cache()
+
+
 @receiver(post_save, sender=DataRelease)
 def generate_data_release_full_export(sender, instance, created, **kwargs):
     if not created and instance.active and not instance.active_at:
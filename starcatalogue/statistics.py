@@ -0,0 +1,92 @@
+import logging
+
+import numpy
+
+from .photometry import Photometry
+
+
+logger = logging.getLogger(__name__)
+
+ZERO_POINT_MAGNITUDE = 15
+
+# Columns of the array returned by magnitude_stats
+MEAN_MAGNITUDE = 0
+MIN_MAGNITUDE = 1
+MAX_MAGNITUDE = 2
+AMPLITUDE = 3
+
+
+def flux_to_magnitude(flux):
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return ZERO_POINT_MAGNITUDE - 2.5 * numpy.log10(flux)
+
+
+def magnitude_stats(fluxes):
+    """
+    Calculates the mean, minimum and maximum magnitudes and the amplitude of many
+    lightcurves at once, given a list of 1D flux arrays with the outliers removed.
+
+    The fluxes are concatenated and reduced in segments, so the cost per star is a
+    few array operations rather than a Python loop. Returns a (len(fluxes), 4)
+    array, with NaN in the rows of empty lightcurves.
+    """
+    lengths = numpy.array([len(flux) for flux in fluxes], dtype=numpy.intp)
+    stats = numpy.full((len(fluxes), 4), numpy.nan)
+    non_empty = lengths > 0
+    if non_empty.any():
+        flux = numpy.concatenate(fluxes).astype(numpy.float64, copy=False)
+        starts = (numpy.cumsum(lengths) - lengths)[non_empty]
+        # Fainter stars have larger magnitudes, so the minimum magnitude comes from
+        # the minimum flux
+        stats[non_empty, MEAN_MAGNITUDE] = flux_to_magnitude(
+            numpy.add.reduceat(flux, starts) / lengths[non_empty]
+        )
+        stats[non_empty, MIN_MAGNITUDE] = flux_to_magnitude(
+            numpy.minimum.reduceat(flux, starts)
+        )
+        stats[non_empty, MAX_MAGNITUDE] = flux_to_magnitude(
+            numpy.maximum.reduceat(flux, starts)
+        )
+    stats[:, AMPLITUDE] = stats[:, MIN_MAGNITUDE] - stats[:, MAX_MAGNITUDE]
+    return stats
+
+
+def photometry_magnitude_stats(paths, fits_paths=None):
+    """
+    Reads the photometry files at paths and calculates their magnitude_stats. Where
+    fits_paths has a path rather than None, the photometry file is first written
+    from that FITS file.
+
+    Returns the stats, a boolean array of which stars' photometry could be read and
+    a boolean array of which FITS files couldn't be read. This doesn't touch the
+    database, so it can run in a pool of processes.
+    """
+    fits_paths = fits_paths or [None] * len(paths)
+    fluxes = []
+    readable = numpy.ones(len(paths), dtype=bool)
+    bad_fits = numpy.zeros(len(paths), dtype=bool)
+    for i, (path, fits_path) in enumerate(zip(paths, fits_paths)):
+        fluxes.append(numpy.empty(0))
+        if fits_path is not None:
+            try:
+                photometry = Photometry.from_fits(fits_path)
+            except (OSError, KeyError, ValueError):
+                logger.warning(f"Could not read FITS file {fits_path}")
+                readable[i] = False
+                bad_fits[i] = True
+                continue
+            try:
+                photometry.write(path)
+            except OSError:
+                logger.warning(f"Could not write photometry file {path}")
+                readable[i] = False
+                continue
+        else:
+            try:
+                photometry = Photometry.load(path)
+            except (OSError, ValueError):
+                logger.warning(f"Could not read photometry file {path}")
+                readable[i] = False
+                continue
+        fluxes[i] = photometry.flux[~photometry.mask]
+    return magnitude_stats(fluxes), readable, bad_fits
@@ -1,17 +1,14 @@
-import csv
 import datetime
+import http.client
 import io
-import urllib
+import logging
+import tempfile
 import yaml
 import time
 import zipfile
 import ujson as json
 
 import pandas
-import seaborn
-
-from astropy.table import vstack
-from astropy.units import Quantity
 
 from celery import shared_task
 
@@ -20,20 +17,32 @@ from django.core.files import File
 from django.core.files.base import ContentFile
 from django.db.models import Q, F
 
-from matplotlib import pyplot
-
-from pathlib import Path
-
 from panoptes_client import Subject, Project
-from PIL import Image
 
 from .models import (
     AggregatedClassification,
+    CatalogueEntry,
     DataRelease,
     Star,
     FoldedLightcurve,
+    StagedFITSFile,
     ZooniverseSubject,
 )
+from .classifications import AGGREGATION_COLUMNS, ClassificationStore
+from .downloads import DownloadError, FITSDownloader, get_fits_downloader
+from .downsampling import encode_levels
+from .releases import (
+    CLASSIFICATIONS_PROGRESS,
+    aggregate_votes,
+    carry_forward_classifications,
+    get_changed_subjects,
+    import_aggregated_classifications,
+    read_classification_export,
+)
+from .rendering import get_renderer
+
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
@@ -50,185 +59,303 @@ def generate_export(export_id):
     export.export_status = export.STATUS_RUNNING
     export.save()
 
+    def update_progress(exported_records):
+        DataExport.objects.filter(id=export.id).update(
+            progress=float(exported_records) / total_records * 100
+        )
+
     try:
-        export_csv = io.StringIO()
-        w = csv.DictWriter(export_csv, fieldnames=EXPORT_DATA_DESCRIPTION.keys())
-        w.writeheader()
         total_records = export.queryset.count()
-        for i, record in enumerate(export.queryset):
-            if i % 1000 == 0:
-                export.progress = float(i) / total_records * 100
-                export.save()
-            w.writerow(gen_export_record_dict(record))
-
-        export_file = ContentFile(b"")
-        with zipfile.ZipFile(
-            export_file, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9
-        ) as export_zip:
-            export_zip.writestr("export.csv", export_csv.getvalue())
-            export_zip.writestr("fields.yaml", yaml.dump(EXPORT_DATA_DESCRIPTION))
-            export_zip.writestr(
-                "params.yaml",
-                yaml.dump(gen_export_params_yaml_dict(export, total_records)),
-            )
-        export.export_file.save(export.EXPORT_FILE_NAME, export_file)
+        with tempfile.TemporaryFile() as export_file:
+            with zipfile.ZipFile(
+                export_file, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9
+            ) as export_zip:
+                # CSV data takes the zip's compression
+                data_entry_info = export.export_data_file_name
+                if export.export_format == export.FORMAT_FITS:
+                    # Stored uncompressed, so the table can be memory mapped from
+                    # the zip without inflating it first
+                    data_entry_info = zipfile.ZipInfo(
+                        export.export_data_file_name,
+                        date_time=time.localtime(time.time())[:6],
+                    )
+                    data_entry_info.compress_type = zipfile.ZIP_STORED
+                    data_entry_info.external_attr = 0o644 << 16
+                # Rows are written straight into the zip entry, so memory use
+                # doesn't grow with the size of the export
+                with export_zip.open(
+                    data_entry_info, "w", force_zip64=True
+                ) as data_entry:
+                    if export.export_format == export.FORMAT_FITS:
+                        write_export_fits(
+                            gen_export_records(export.queryset, sexagesimal=False),
+                            data_entry,
+                            update_progress,
+                        )
+                    else:
+                        with io.TextIOWrapper(
+                            data_entry, encoding="utf-8", newline=""
+                        ) as export_csv:
+                            write_export_csv(
+                                gen_export_records(export.queryset),
+                                export_csv,
+                                update_progress,
+                            )
+                export_zip.writestr("fields.yaml", yaml.dump(EXPORT_DATA_DESCRIPTION))
+                export_zip.writestr(
+                    "params.yaml",
+                    yaml.dump(gen_export_params_yaml_dict(export, total_records)),
+                )
+            export.export_file.save(export.export_file_name, File(export_file))
     except:
         export.export_status = export.STATUS_FAILED
         export.save()
         raise
 
+    export.progress = 100.0
     export.export_status = export.STATUS_COMPLETE
     export.save()
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def download_fits(star_id):
     star = Star.objects.get(id=star_id)
     if star.fits_error_count >= settings.FITS_DOWNLOAD_ATTEMPTS:
+        star.set_asset_status("fits_status", star.ASSET_FAILED)
         return
-    encoded_params = urllib.parse.urlencode(
-        {"objid": star.superwasp_id.replace("1SWASP", "1SWASP ")},
-        quote_via=urllib.parse.quote,
-    )
-    fits_file_name = f"{star.superwasp_id}.fits"
-    missing_paths = (Path(settings.MEDIA_ROOT) / "missing").glob(
-        f"batch_*/{fits_file_name}"
-    )
-    unlink_missing = False
-    open_file = False
-    try:
-        for missing_path in missing_paths:
-            fits_f = open(missing_path, "rb")
-            open_file = True
-            fits_data = File(fits_f)
-            unlink_missing = missing_path
-            break
-        else:
-            fits_url = f"http://wasp.warwick.ac.uk/lcextract?{encoded_params}"
+    star.set_asset_status("fits_status", star.ASSET_RUNNING)
+
+    staged = StagedFITSFile.objects.filter(superwasp_id=star.superwasp_id).first()
+    if staged is None or not staged.ingest(star):
+        with tempfile.TemporaryFile() as fits_f:
             try:
-                fits_data = urllib.request.urlopen(fits_url, timeout=30)
-            except urllib.request.HTTPError:
-                star.fits_error_count += 1
-                star.save()
+                get_fits_downloader().fetch(star.superwasp_id, fits_f)
+            except (DownloadError, http.client.HTTPException, OSError) as e:
+                logger.warning(
+                    f"Could not download FITS file for {star.superwasp_id}: {e}"
+                )
+                star.fits_download_failed()
                 return
-        star.fits_file.save(fits_file_name, fits_data)
-        star.save()
-    finally:
-        if open_file:
-            fits_f.close()
+            star.save_fits(fits_f)
+
+    star.process_fits()
+
+
+@shared_task(ignore_result=True)
+def download_fits_files(star_ids, concurrency=None):
+    """
+    Downloads the FITS files for many stars at once, over a pool of connections.
+    Stars which already have a download in flight are skipped. Returns the number of
+    files saved.
+
+    The stars are claimed FITS_DOWNLOAD_CLAIM_SIZE at a time, just before they're
+    downloaded, so that none is left claimed for longer than ASSET_TASK_TIMEOUT.
+    Batch directories staged since the last run are indexed first.
+    """
+    StagedFITSFile.update_index()
+    saved = 0
+    with FITSDownloader(concurrency=concurrency) as downloader:
+        for start in range(0, len(star_ids), settings.FITS_DOWNLOAD_CLAIM_SIZE):
+            saved += download_claimed_fits_files(
+                downloader,
+                Star.claim_fits_downloads(
+                    star_ids[start : start + settings.FITS_DOWNLOAD_CLAIM_SIZE]
+                ),
+            )
+    return saved
+
+
+def download_claimed_fits_files(downloader, stars):
+    """
+    Ingests or downloads the FITS files for stars claimed by claim_fits_downloads,
+    and queues their processing. Returns the number of files saved.
+    """
+    saved = []
+    to_download = []
+    staged_files = {
+        staged.superwasp_id: staged
+        for staged in StagedFITSFile.objects.filter(superwasp_id__in=list(stars))
+    }
+    for superwasp_id, star in stars.items():
+        staged = staged_files.get(superwasp_id)
+        if staged is not None and staged.ingest(star):
+            saved.append(star)
+        else:
+            to_download.append(superwasp_id)
+
+    for superwasp_id, fits_f, error in downloader.download(to_download):
+        star = stars[superwasp_id]
+        if error is not None:
+            # Network problems count too, so a star whose download always times
+            # out is eventually given up on rather than retried every run
+            logger.warning(f"Could not download FITS file for {superwasp_id}: {error}")
+            star.fits_download_failed()
+        else:
+            star.save_fits(fits_f)
+            saved.append(star)
 
-    if unlink_missing is not False:
-        unlink_missing.unlink()
+    # Processing is CPU bound, so it's spread across the workers
+    for star in saved:
+        process_fits.delay(star.id)
+    return len(saved)
 
-    star.get_image_location()
-    star.calculate_magnitudes()
 
-    for lightcurve in star.foldedlightcurve_set.all():
-        lightcurve.get_image_location()
+@shared_task(ignore_result=True)
+def process_fits(star_id):
+    Star.objects.get(id=star_id).process_fits()
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def generate_star_json_files(star_id):
     star = Star.objects.get(id=star_id)
 
     if not star.fits:
+        # The download task queues the other files once it has finished
+        star.set_asset_status("json_status", star.ASSET_MISSING)
+        star.queue_fits_download()
         return
 
-    ts = star.timeseries
-    if not ts:
+    star.set_asset_status("json_status", star.ASSET_RUNNING)
+    photometry = star.photometry
+    if not photometry:
+        star.set_asset_status("json_status", star.ASSET_FAILED)
         return
-    ts_flux = Star.outlier_clip(ts["TAMFLUX2"])
+    keep = ~photometry.mask
     # Format based on Zooniverse lightcurve viewer requirements:
     # https://github.com/zooniverse/front-end-monorepo/blob/master/packages/lib-classifier/src/components/Classifier/components/SubjectViewer/components/ScatterPlotViewer/README.md#scatter-plot-viewer
     ts_data = {
         "data": {
-            "x": list((ts.time.jd[~ts_flux.mask]).astype(float)),
-            "y": list(ts_flux[~ts_flux.mask].astype(float)),
+            "x": photometry.hjd[keep].tolist(),
+            "y": photometry.flux[keep].tolist(),
         },
     }
 
     json_data = ContentFile("")
     json.dump(ts_data, json_data)
-    star.json_file.save("lightcurve.json", json_data)
+    star.json_file.save("lightcurve.json", json_data, save=False)
+
+    lightcurve_data, star.lightcurve_data_levels = encode_levels(
+        photometry.hjd[keep], photometry.flux[keep]
+    )
+    star.lightcurve_data_file.save(
+        "lightcurve.bin", ContentFile(lightcurve_data), save=False
+    )
     star.json_version = star.CURRENT_JSON_VERSION
-    star.save()
+    star.json_status = star.ASSET_COMPLETE
+    star.save(
+        update_fields=[
+            "json_file",
+            "lightcurve_data_file",
+            "lightcurve_data_levels",
+            "json_version",
+            "json_status",
+        ]
+    )
 
 
-@shared_task
+@shared_task(ignore_result=True)
+def generate_star_lightcurve_images(star_id):
+    star = Star.objects.get(id=star_id)
+    lightcurves = list(star.foldedlightcurve_set.filter(FoldedLightcurve.needs_image()))
+    if not lightcurves:
+        return
+    lightcurve_statuses = FoldedLightcurve.objects.filter(
+        id__in=[lightcurve.id for lightcurve in lightcurves]
+    )
+
+    if not star.fits:
+        # The download task queues the images again once it has finished
+        lightcurve_statuses.update(image_status=FoldedLightcurve.ASSET_MISSING)
+        star.queue_fits_download()
+        return
+
+    lightcurve_statuses.update(image_status=FoldedLightcurve.ASSET_RUNNING)
+    # Loaded once and shared by every period
+    photometry = star.photometry
+    if not photometry:
+        lightcurve_statuses.update(image_status=FoldedLightcurve.ASSET_FAILED)
+        return
+
+    for lightcurve in lightcurves:
+        lightcurve.star = star
+        # One failure mustn't leave the remaining lightcurves running until the
+        # claim times out
+        try:
+            save_lightcurve_images(lightcurve, photometry)
+        except Exception:
+            logger.exception(f"Could not render images for lightcurve {lightcurve.id}")
+            lightcurve.set_asset_status("image_status", lightcurve.ASSET_FAILED)
+
+
+@shared_task(ignore_result=True)
 def generate_lightcurve_images(lightcurve_id):
     lightcurve = FoldedLightcurve.objects.get(id=lightcurve_id)
 
     if not lightcurve.star.fits:
+        lightcurve.set_asset_status("image_status", lightcurve.ASSET_MISSING)
+        lightcurve.star.queue_fits_download()
         return
 
-    ts = lightcurve.timeseries
-    if not ts:
+    lightcurve.set_asset_status("image_status", lightcurve.ASSET_RUNNING)
+    photometry = lightcurve.star.photometry
+    if not photometry:
+        lightcurve.set_asset_status("image_status", lightcurve.ASSET_FAILED)
         return
-    epoch_length = ts["time"].max() - ts["time"].min()
-    ts_extend = ts.copy()
-    ts_extend["time"] = ts_extend["time"] + epoch_length
-    ts = vstack([ts, ts_extend])
-    ts_flux = Star.outlier_clip(ts["TAMFLUX2"])
-    ts_data = {
-        "phase": (ts.time / epoch_length) - Quantity(0.5, unit=None),
-        "flux": ts_flux,
-    }
-    fig = pyplot.figure()
-    plot = seaborn.scatterplot(
-        data=ts_data,
-        x="phase",
-        y="flux",
-        alpha=0.5,
-        s=1,
+    save_lightcurve_images(lightcurve, photometry)
+
+
+def save_lightcurve_images(lightcurve, photometry):
+    folded = lightcurve.fold(cycles=2, photometry=photometry)
+    if folded is None or not len(folded[0]):
+        lightcurve.set_asset_status("image_status", lightcurve.ASSET_FAILED)
+        return
+    phase, flux = folded
+    image_data, thumbnail_data = get_renderer().render(
+        phase,
+        flux,
+        title=f"{lightcurve.star.superwasp_id} Period {lightcurve.period_length}s",
+        xlabel="phase",
+    )
+    lightcurve.image_file.save(
+        f"lightcurve-{lightcurve.id}.png", ContentFile(image_data), save=False
     )
-    plot.set_title(f"{lightcurve.star.superwasp_id} Period {lightcurve.period_length}s")
-    image_data = ContentFile(b"")
-    fig.savefig(image_data)
-    lightcurve.image_file.save(f"lightcurve-{lightcurve.id}.png", image_data)
-
-    thumbnail_data = ContentFile(b"")
-    thumbmail_image = Image.open(image_data)
-    thumbmail_image.thumbnail((100, 60))
-    thumbmail_image.save(thumbnail_data, format="png")
     lightcurve.thumbnail_file.save(
-        f"lightcurve-{lightcurve.id}-small.png", thumbnail_data
+        f"lightcurve-{lightcurve.id}-small.png",
+        ContentFile(thumbnail_data),
+        save=False,
     )
 
     lightcurve.image_version = lightcurve.CURRENT_IMAGE_VERSION
-    lightcurve.save()
-    pyplot.close()
+    lightcurve.image_status = lightcurve.ASSET_COMPLETE
+    lightcurve.save(
+        update_fields=["image_file", "thumbnail_file", "image_version", "image_status"]
+    )
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def generate_star_images(star_id):
     star = Star.objects.get(id=star_id)
 
     if not star.fits:
+        star.set_asset_status("image_status", star.ASSET_MISSING)
+        star.queue_fits_download()
         return
 
-    ts = star.timeseries
-    if not ts:
+    star.set_asset_status("image_status", star.ASSET_RUNNING)
+    photometry = star.photometry
+    if not photometry:
+        star.set_asset_status("image_status", star.ASSET_FAILED)
         return
-    ts_flux = Star.outlier_clip(ts["TAMFLUX2"])
-    ts_data = {
-        "time": ts.time.jd,
-        "flux": ts_flux,
-    }
-    fig = pyplot.figure()
-    plot = seaborn.scatterplot(
-        data=ts_data,
-        x="time",
-        y="flux",
-        alpha=0.5,
-        s=1,
+    image_data, _ = get_renderer().render(
+        photometry.hjd,
+        photometry.clipped_flux,
+        title=star.superwasp_id,
+        xlabel="time",
     )
-    plot.set_title(star.superwasp_id)
-    image_data = ContentFile(b"")
-    fig.savefig(image_data)
-    star.image_file.save(f"lightcurve.png", image_data)
+    star.image_file.save(f"lightcurve.png", ContentFile(image_data), save=False)
     star.image_version = star.CURRENT_IMAGE_VERSION
-    star.save()
-    pyplot.close()
+    star.image_status = star.ASSET_COMPLETE
+    star.save(update_fields=["image_file", "image_version", "image_status"])
 
 
 @shared_task
@@ -251,111 +378,69 @@ def save_zooniverse_metadata(vespa_subject_id):
 
 @shared_task
 def prepare_data_release(data_release_id):
-    period_certainty_overrides = {
-        "Rotator": "Correct period",
-        "Unknown": "Correct period",
-        "Junk": "Wrong period",
-    }
     # This task seems to hit a race condition sometimes where the DataRelease hasn't
     # actually been saved yet
     time.sleep(5)
     data_release = DataRelease.objects.get(id=data_release_id)
 
-    classifications = None
+    # We count classifications from both workflows, to correctly aggregate subjects
+    # which were filtered as junk after receiving classifications in the main
+    # workflow.
+    workflow_ids = (
+        settings.ZOONIVERSE_MAIN_WORKFLOW_ID,
+        settings.ZOONIVERSE_JUNK_WORKFLOW_ID,
+    )
+    project = Project(settings.ZOONIVERSE_PROJECT_ID)
 
     if settings.ZOONIVERSE_CACHE_EXPORT:
-        try:
-            classifications = pandas.read_pickle("classifications.pkl")
-        except FileNotFoundError:
-            classification_export = Project(settings.ZOONIVERSE_PROJECT_ID).get_export(
-                "classifications"
+        store = ClassificationStore(settings.CLASSIFICATION_STORE_ROOT)
+        export_date = datetime.datetime.fromisoformat(
+            project.describe_export("classifications")["media"][0]["updated_at"]
+        )
+        if store.latest_export_date is None or export_date > store.latest_export_date:
+            classification_export = project.get_export("classifications")
+            classification_export.raw.decode_content = True
+            store.append(
+                read_classification_export(
+                    classification_export.raw,
+                    workflow_ids,
+                    after_classification_id=store.last_classification_id,
+                ),
+                export_date,
             )
+            del classification_export
+        classifications = store.load(AGGREGATION_COLUMNS, export_date=export_date)
     else:
-        classification_export = Project(settings.ZOONIVERSE_PROJECT_ID).get_export(
+        # Can't load it all into pandas because of limited memory, so it's streamed
+        # and parsed in chunks
+        classification_export = project.get_export(
             "classifications", generate=data_release.generate_export
         )
-
-    if classifications is None:
-        classifications = {
-            "subject_id": [],
-            "classification": [],
-            "period_certainty": [],
-            "user_name": [],
-        }
-        # Can't load it all into pandas because of limited memory
-        for row in classification_export.csv_dictreader():
-            # We count classifications from both workflows, to correctly aggregate subjects
-            # which were filtered as junk after receiving classifications in the main
-            # workflow.
-            if int(row["workflow_id"]) not in (
-                settings.ZOONIVERSE_MAIN_WORKFLOW_ID,
-                settings.ZOONIVERSE_JUNK_WORKFLOW_ID,
-            ):
-                continue
-            annotations = json.loads(row["annotations"])
-            classification = annotations[0]["value"]
-            if classification == "Real":
-                # We don't need these as they are subsequently classified in the main workflow
-                continue
-            classifications["classification"].append(classification)
-            try:
-                period_certainty = annotations[1]["value"]
-            except IndexError:
-                period_certainty = None
-            # Prepend primary classification to period certainty vote so we can count votes for
-            # each primary class separately.
-            classifications["period_certainty"].append(
-                f"{classification} {period_certainty_overrides.get(classification, period_certainty)}"
-            )
-            classifications["subject_id"].append(int(row["subject_ids"]))
-            classifications["user_name"].append(row["user_name"])
+        classification_export.raw.decode_content = True
+        classifications = read_classification_export(
+            classification_export.raw, workflow_ids
+        )
         del classification_export
-        classifications = pandas.DataFrame(classifications)
-        classifications.drop_duplicates(
-            subset=["user_name", "subject_id"], inplace=True
+
+    base_release = None
+    if data_release.incremental:
+        base_release = data_release.get_incremental_base()
+    if len(classifications):
+        data_release.last_classification_id = int(
+            classifications["classification_id"].max()
         )
-        if settings.ZOONIVERSE_CACHE_EXPORT:
-            try:
-                classifications.to_pickle("classifications.pkl")
-            except PermissionError:
-                pass
-
-    aggregated_classifications = classifications.pivot_table(
-        columns=["classification"],
-        values="user_name",
-        index="subject_id",
-        aggfunc=len,
-        fill_value=0,
-    )
-    aggregated_classifications["consensus class"] = aggregated_classifications[
-        [  # The ordering of columns matters here for tie breaking
-            "Junk",
-            "Pulsator",
-            "Rotator",
-            "EW type",
-            "EA/EB type",
-            "Unknown",
+    if base_release is not None:
+        changed_subject_ids = get_changed_subjects(
+            classifications, base_release.last_classification_id
+        )
+        classifications = classifications[
+            classifications["subject_id"].isin(changed_subject_ids)
         ]
-    ].idxmax(axis="columns")
-
-    aggregated_period_certainties = classifications.pivot_table(
-        columns=["period_certainty"],
-        values="user_name",
-        index="subject_id",
-        aggfunc=len,
-        fill_value=0,
-    )
+        data_release.base_release = base_release
 
+    aggregated_classifications = aggregate_votes(classifications)
     del classifications
 
-    aggregated_classifications = aggregated_classifications.join(
-        aggregated_period_certainties,
-    )
-
-    aggregated_classifications = aggregated_classifications[
-        aggregated_classifications["consensus class"] != "Junk"
-    ]
-
     zoo_lookup = pandas.read_csv(
         settings.IMPORT_ROOT / "lookup.dat",
         delim_whitespace=True,
@@ -409,90 +494,33 @@ def prepare_data_release(data_release_id):
             settings.DATA_RELEASE_IMPORT_LIMIT
         )
 
-    CLASSIFICATION_LOOKUP = {
-        "EA/EB type": AggregatedClassification.EA_EB,
-        "EW type": AggregatedClassification.EW,
-        "Pulsator": AggregatedClassification.PULSATOR,
-        "Rotator": AggregatedClassification.ROTATOR,
-        "Unknown": AggregatedClassification.UNKNOWN,
-        "Wrong period": AggregatedClassification.UNCERTAIN,
-        "Correct period": AggregatedClassification.CERTAIN,
-        "Half correct period": AggregatedClassification.HALF,
-    }
-
-    for subject_id, row in aggregated_classifications.iterrows():
-        star, _ = Star.objects.get_or_create(superwasp_id=row["SWASP ID"])
-
-        try:
-            zoo_subject = ZooniverseSubject.objects.get(zooniverse_id=subject_id)
-            folded_lightcurve = zoo_subject.lightcurve
-        except ZooniverseSubject.DoesNotExist:
-            zoo_subject = None
-            # Because of earlier data issues there can be duplicate lightcurves, but it is
-            # safe to just use the first one and ignore the others
-            folded_lightcurve = FoldedLightcurve.objects.filter(
-                star=star, period_number=row["Period Number"]
-            ).first()
-
-        if folded_lightcurve is None:
-            folded_lightcurve = FoldedLightcurve.objects.create(
-                star=star,
-                period_number=row["Period Number"],
-                period_length=row["Original Period"],
-                sigma=row["Sigma"],
-                chi_squared=row["Chi Squared"],
-            )
-        elif (
-            folded_lightcurve.period_length != row["Original Period"]
-            or folded_lightcurve.sigma != row["Sigma"]
-            or folded_lightcurve.chi_squared != row["Chi Squared"]
-        ):
-            folded_lightcurve.updated_period_length = row["Original Period"]
-            folded_lightcurve.updated_sigma = row["Sigma"]
-            folded_lightcurve.updated_chi_squared = row["Chi Squared"]
-            folded_lightcurve.save()
-
-        if zoo_subject is None:
-            ZooniverseSubject.objects.get_or_create(
-                zooniverse_id=subject_id, lightcurve=folded_lightcurve
-            )
-
-        if row["consensus class"] in period_certainty_overrides:
-            period_certainty = period_certainty_overrides[row["consensus class"]]
-        else:
-            column_order = [
-                f"{row['consensus class']} Correct period",
-                f"{row['consensus class']} Wrong period",
-            ]
-            if row["consensus class"] != "Pulsator":
-                column_order = [
-                    f"{row['consensus class']} Half correct period",
-                ] + column_order
-            period_certainty = (
-                pandas.to_numeric(row[column_order])
-                .idxmax()
-                .replace(f"{row['consensus class']} ", "")
-            )
-
-        AggregatedClassification.objects.create(
-            data_release=data_release,
-            lightcurve=folded_lightcurve,
-            classification=CLASSIFICATION_LOOKUP[row["consensus class"]],
-            period_uncertainty=CLASSIFICATION_LOOKUP[period_certainty],
-            classification_count=sum(
-                row[t]
-                for t in [
-                    "EA/EB type",
-                    "EW type",
-                    "Pulsator",
-                    "Rotator",
-                    "Unknown",
-                    "Junk",
-                ]
-            ),
+    # Progress is shared between importing and carrying forward by their numbers of
+    # rows
+    import_progress = CLASSIFICATIONS_PROGRESS
+    if base_release is not None:
+        carried_rows = base_release.aggregatedclassification_set.count()
+        import_progress *= len(aggregated_classifications) / max(
+            len(aggregated_classifications) + carried_rows, 1
+        )
+    import_aggregated_classifications(
+        data_release,
+        aggregated_classifications,
+        progress_range=(0, import_progress),
+    )
+    if base_release is not None:
+        carry_forward_classifications(
+            base_release,
+            data_release,
+            changed_subject_ids,
+            progress_range=(import_progress, CLASSIFICATIONS_PROGRESS),
         )
 
+    # Build the catalogue now so it's ready as soon as the release is activated. It's
+    # rebuilt on activation to pick up any corrected lightcurve metadata.
+    CatalogueEntry.build(data_release)
+
     data_release.aggregation_finished = datetime.datetime.now()
+    data_release.progress = 100.0
     data_release.save()
 
 
@@ -520,12 +548,15 @@ def activate_data_release(data_release_id):
     )
 
     data_release = DataRelease.objects.get(pk=data_release_id)
-    # Now pre-generate the full data export
-    DataExport.objects.create(
-        data_release=data_release,
-        data_version=data_release.version,
-        in_data_archive=True,
-    )
+    CatalogueEntry.build(data_release)
+    # Now pre-generate the full data exports
+    for export_format, _ in DataExport.FORMAT_CHOICES:
+        DataExport.objects.create(
+            data_release=data_release,
+            data_version=data_release.version,
+            in_data_archive=True,
+            export_format=export_format,
+        )
     data_release.active_at = datetime.datetime.now()
     data_release.save()
 
@@ -533,6 +564,8 @@ def activate_data_release(data_release_id):
 from .exports import (
     EXPORT_DATA_DESCRIPTION,
     gen_export_params_yaml_dict,
-    gen_export_record_dict,
+    gen_export_records,
+    write_export_csv,
+    write_export_fits,
     DataExport,
 )
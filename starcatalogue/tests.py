@@ -1,3 +1,1082 @@
-from django.test import TestCase
+import datetime
+import http.client
+import http.server
+import io
+import json
+import os
+import tempfile
+import threading
+import urllib.parse
+import uuid
 
-# Create your tests here.
+from unittest import mock
+
+import astropy.io.fits as fits
+import numpy
+import pandas
+
+from astropy import units
+from astropy.time import Time
+from astropy.timeseries import TimeSeries
+from PIL import Image
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import QueryDict
+from django.urls import reverse
+from django.utils import timezone
+
+from starcatalogue.caching import invalidate_results_cache
+from starcatalogue.exports import (
+    EXPORT_DATA_DESCRIPTION,
+    EXPORT_QUERYSET_FIELDS,
+    gen_export_records_frame,
+    write_export_fits,
+)
+from starcatalogue.models import (
+    AggregatedClassification,
+    CatalogueEntry,
+    DataRelease,
+    FoldedLightcurve,
+    Star,
+    StagedFITSFile,
+    ZooniverseSubject,
+)
+from starcatalogue.classifications import ClassificationStore
+from starcatalogue.downloads import DownloadError, FITSDownloader
+from starcatalogue.downsampling import encode_levels, minmax_downsample
+from starcatalogue.folding import fold, fold_many, fold_phase
+from starcatalogue.photometry import Photometry
+from starcatalogue.releases import (
+    aggregate_votes,
+    carry_forward_classifications,
+    get_changed_subjects,
+    import_aggregated_classifications,
+    read_classification_export,
+    update_progress,
+)
+from starcatalogue.rendering import THUMBNAIL_SIZE, LightcurveRenderer
+from starcatalogue.statistics import magnitude_stats, photometry_magnitude_stats
+from starcatalogue.tasks import (
+    download_fits_files,
+    generate_star_lightcurve_images,
+    save_lightcurve_images,
+)
+from starcatalogue.views import StarListView
+
+
+class StarListViewQueryCountTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        with mock.patch("starcatalogue.signals.prepare_data_release"):
+            cls.data_release = DataRelease.objects.create(
+                version=1.0, active=True, active_at=timezone.now()
+            )
+
+    def create_rows(self, count):
+        offset = Star.objects.count()
+        for n in range(offset, offset + count):
+            star = Star.objects.create(
+                superwasp_id=f"1SWASPJ0000{n:02d}.00+000000.0",
+                _mean_magnitude=12.0,
+                _min_magnitude=12.5,
+                _max_magnitude=11.5,
+                _amplitude=1.0,
+                stats_version=Star.CURRENT_STATS_VERSION,
+                location=(n / 10, 0),
+            )
+            lightcurve = FoldedLightcurve.objects.create(
+                star=star,
+                period_number=1,
+                period_length=1000.0 + n,
+                sigma=0.1,
+                chi_squared=1.0,
+                image_file=f"sources/{star.superwasp_id}/lightcurve.png",
+                thumbnail_file=f"sources/{star.superwasp_id}/lightcurve-small.png",
+                image_version=FoldedLightcurve.CURRENT_IMAGE_VERSION,
+            )
+            ZooniverseSubject.objects.create(zooniverse_id=n, lightcurve=lightcurve)
+            AggregatedClassification.objects.create(
+                data_release=self.data_release,
+                lightcurve=lightcurve,
+                classification=AggregatedClassification.PULSATOR,
+                period_uncertainty=AggregatedClassification.CERTAIN,
+                classification_count=5,
+            )
+        CatalogueEntry.build(self.data_release)
+
+    def count_queries(self, url, clear_cache=True):
+        if clear_cache:
+            invalidate_results_cache()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_independent_of_page_size(self):
+        for url in (reverse("vespa"), reverse("browse")):
+            AggregatedClassification.objects.all().delete()
+            self.create_rows(2)
+            small_page_queries = self.count_queries(url)
+            self.create_rows(18)
+            full_page_queries = self.count_queries(url)
+            self.assertEqual(small_page_queries, full_page_queries)
+
+    def test_pages_read_catalogue_without_joins(self):
+        self.create_rows(5)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("browse"))
+        self.assertContains(response, "1SWASPJ000004.00+000000.0")
+        self.assertContains(response, "lightcurve-small.png")
+        catalogue_queries = [
+            query["sql"]
+            for query in queries
+            if 'FROM "starcatalogue_catalogueentry"' in query["sql"]
+        ]
+        self.assertTrue(catalogue_queries)
+        for sql in catalogue_queries:
+            self.assertNotIn("JOIN", sql)
+
+    def test_cached_results(self):
+        self.create_rows(5)
+        url = reverse("browse")
+        uncached_queries = self.count_queries(url)
+        self.assertLess(self.count_queries(url, clear_cache=False), uncached_queries)
+        self.data_release.progress = 50.0
+        self.data_release.save()
+        self.assertLess(self.count_queries(url, clear_cache=False), uncached_queries)
+        self.data_release.active_at = timezone.now()
+        self.data_release.save()
+        self.assertEqual(self.count_queries(url, clear_cache=False), uncached_queries)
+
+
+class StarCoordsTestCase(SimpleTestCase):
+    superwasp_ids = [
+        "1SWASPJ000000.15+320054.7",
+        "1SWASPJ123456.78-012345.6",
+        "1SWASPJ235959.99-002345.6",
+    ]
+
+    def test_parse_superwasp_ids_matches_skycoord(self):
+        ra, dec = Star.parse_superwasp_ids(self.superwasp_ids)
+        for i, superwasp_id in enumerate(self.superwasp_ids):
+            coords = Star(superwasp_id=superwasp_id).coords
+            self.assertAlmostEqual(ra[i], coords.ra.deg, places=10)
+            self.assertAlmostEqual(dec[i], coords.dec.deg, places=10)
+
+    def test_parse_superwasp_ids_rejects_malformed_ids(self):
+        with self.assertRaises(ValueError):
+            Star.parse_superwasp_ids(["1SWASPJ000000.1+320054.7"])
+
+
+class PhotometryTestCase(SimpleTestCase):
+    def test_round_trip(self):
+        hjd = numpy.linspace(2453005.5, 2453105.5, 50)
+        flux = Star.outlier_clip(numpy.append(numpy.ones(49), 1e6))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            photometry_path = os.path.join(tmp_dir, "photometry.npy")
+            Photometry.from_arrays(hjd, flux).save(photometry_path)
+            photometry = Photometry.load(photometry_path)
+            self.assertEqual(len(photometry), 50)
+            numpy.testing.assert_array_equal(photometry.hjd, hjd)
+            numpy.testing.assert_array_equal(photometry.mask, flux.mask)
+            self.assertEqual(photometry.clipped_flux.max(), 1)
+            self.assertTrue(photometry.hjd.flags["C_CONTIGUOUS"])
+            del photometry
+
+
+class FoldingTestCase(SimpleTestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(1)
+        self.time = numpy.sort(rng.uniform(2453005.5, 2453105.5, 200))
+        self.flux = rng.normal(100, 5, 200)
+
+    def test_fold_phase_matches_astropy(self):
+        period = 0.731
+        ts = TimeSeries(time=Time(self.time, format="jd"), data={"flux": self.flux})
+        expected = ts.fold(period=period * units.day).time.jd
+        phase = fold_phase(self.time, period)
+        numpy.testing.assert_allclose(
+            (numpy.mod(phase + 0.5, 1) - 0.5) * period, expected, atol=1e-9
+        )
+
+    def test_fold_repeats_cycles(self):
+        phase, flux = fold(self.time, self.flux, 1.5, cycles=2)
+        self.assertEqual(phase.shape, (400,))
+        self.assertTrue(((phase >= -1) & (phase < 1)).all())
+        numpy.testing.assert_array_equal(phase[200:] - phase[:200], 1)
+        numpy.testing.assert_array_equal(flux, numpy.tile(self.flux, 2))
+
+    def test_fold_matches_astropy_images(self):
+        # Lightcurve images used to plot TimeSeries.fold's phase minus 0.5, repeated
+        # over two cycles
+        period = 0.731
+        ts = TimeSeries(time=Time(self.time, format="jd"), data={"flux": self.flux})
+        expected = ts.fold(period=period * units.day).time.jd / period
+        phase, _ = fold(self.time, self.flux, period, cycles=2)
+        numpy.testing.assert_allclose(
+            phase, numpy.concatenate([expected - 0.5, expected + 0.5]), atol=1e-9
+        )
+
+    def test_fold_many_matches_fold(self):
+        periods = [0.5, 1.25, 3.0]
+        phases, flux = fold_many(self.time, self.flux, periods, cycles=3)
+        self.assertEqual(phases.shape, (3, 600))
+        for row, period in zip(phases, periods):
+            phase, _ = fold(self.time, self.flux, period, cycles=3)
+            numpy.testing.assert_allclose(row, phase)
+        numpy.testing.assert_array_equal(flux, numpy.tile(self.flux, 3))
+
+
+class MagnitudeStatsTestCase(SimpleTestCase):
+    def test_magnitude_stats(self):
+        rng = numpy.random.default_rng(3)
+        fluxes = [rng.uniform(100, 1000, n) for n in (5, 0, 1, 200)]
+        stats = magnitude_stats(fluxes)
+        self.assertTrue(numpy.isnan(stats[1]).all())
+        for flux, star_stats in zip(fluxes, stats):
+            if not len(flux):
+                continue
+            min_magnitude = 15 - 2.5 * numpy.log10(flux.min())
+            max_magnitude = 15 - 2.5 * numpy.log10(flux.max())
+            numpy.testing.assert_allclose(
+                star_stats,
+                [
+                    15 - 2.5 * numpy.log10(flux.mean()),
+                    min_magnitude,
+                    max_magnitude,
+                    min_magnitude - max_magnitude,
+                ],
+            )
+
+    def test_photometry_magnitude_stats(self):
+        flux = numpy.ma.MaskedArray([100.0, 1e6, 1000.0], mask=[False, True, False])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "photometry.npy")
+            Photometry.from_arrays(numpy.arange(3.0), flux).save(path)
+            stats, readable, bad_fits = photometry_magnitude_stats(
+                [path, os.path.join(tmpdir, "missing.npy")]
+            )
+        numpy.testing.assert_array_equal(readable, [True, False])
+        numpy.testing.assert_array_equal(bad_fits, [False, False])
+        # The outlier is excluded
+        numpy.testing.assert_allclose(stats[0, 1:3], [10, 7.5])
+
+    def test_photometry_magnitude_stats_from_fits(self):
+        flux = numpy.full(50, 1000.0)
+        flux[10] = 1e6
+        flux[20] = numpy.nan
+        tmid = numpy.arange(50.0) * 600
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fits_path = os.path.join(tmpdir, "star.fits")
+            fits.BinTableHDU.from_columns(
+                [
+                    fits.Column(name="TMID", format="D", array=tmid),
+                    fits.Column(name="TAMFLUX2", format="E", array=flux),
+                ]
+            ).writeto(fits_path)
+            path = os.path.join(tmpdir, "sources", "photometry.npy")
+            stats, readable, bad_fits = photometry_magnitude_stats(
+                [path, os.path.join(tmpdir, "other.npy")],
+                [fits_path, os.path.join(tmpdir, "missing.fits")],
+            )
+            photometry = Photometry.load(path)
+            numpy.testing.assert_allclose(photometry.hjd, tmid / 86400 + 2453005.5)
+            self.assertEqual(numpy.flatnonzero(photometry.mask).tolist(), [10, 20])
+            del photometry
+        numpy.testing.assert_array_equal(readable, [True, False])
+        numpy.testing.assert_array_equal(bad_fits, [False, True])
+        numpy.testing.assert_allclose(stats[0], [7.5, 7.5, 7.5, 0])
+
+
+class LightcurveRendererTestCase(SimpleTestCase):
+    def test_render_image_and_thumbnail(self):
+        renderer = LightcurveRenderer()
+        flux = numpy.ma.masked_greater(numpy.arange(100.0), 90)
+        for title in ("First", "Second"):
+            image_data, thumbnail_data = renderer.render(
+                numpy.linspace(-1, 1, 100), flux, title, "phase"
+            )
+            image = Image.open(io.BytesIO(image_data))
+            thumbnail = Image.open(io.BytesIO(thumbnail_data))
+            self.assertEqual(image.size, (640, 480))
+            self.assertLessEqual(thumbnail.size[0], THUMBNAIL_SIZE[0])
+            self.assertLessEqual(thumbnail.size[1], THUMBNAIL_SIZE[1])
+        self.assertEqual(len(renderer.points.get_offsets()), 91)
+        self.assertLess(renderer.axes.get_ylim()[1], 95)
+
+    def test_density_mode_above_threshold(self):
+        renderer = LightcurveRenderer(density_threshold=50)
+        x = numpy.linspace(-1, 1, 100)
+        renderer.render(x, x**2, "Density", "phase")
+        self.assertTrue(renderer.density.get_visible())
+        self.assertFalse(renderer.points.get_visible())
+        self.assertGreater(renderer.density.get_array().count(), 0)
+
+        renderer.render(x[:50], x[:50] ** 2, "Scatter", "phase")
+        self.assertFalse(renderer.density.get_visible())
+        self.assertEqual(len(renderer.points.get_offsets()), 50)
+
+
+class DownsamplingTestCase(SimpleTestCase):
+    def test_minmax_downsample_keeps_extremes(self):
+        y = numpy.array([5, 1, 9, 3, 3, 2, 8, 4], dtype=float)
+        x = numpy.arange(len(y), dtype=float)
+        numpy.testing.assert_array_equal(minmax_downsample(x, y, 2), [1, 2, 5, 6])
+
+    def test_encode_levels(self):
+        rng = numpy.random.default_rng(2)
+        x = 2453005.5 + numpy.sort(rng.uniform(0, 3000, 5000))
+        y = rng.normal(1000, 50, 5000)
+        data, levels = encode_levels(x, y, level_buckets=(100, 1000, 4000))
+        self.assertEqual([level["points"] for level in levels][-1], 5000)
+        self.assertEqual(len(levels), 3)
+        for level in levels:
+            self.assertEqual(level["offset"] % 8, 0)
+            start = level["offset"]
+            level_x = numpy.frombuffer(data, "<f8", level["points"], start)
+            level_y = numpy.frombuffer(
+                data, "<f4", level["points"], start + level["points"] * 8
+            )
+            self.assertTrue(numpy.isin(level_x, x).all())
+            self.assertEqual(level_y.max(), numpy.float32(y.max()))
+            self.assertEqual(level_y.min(), numpy.float32(y.min()))
+
+
+class FITSDownloaderTestCase(SimpleTestCase):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        REDIRECTS = {
+            "/moved/lcextract": (301, "/lcextract"),
+            "/loop": (302, "/loop"),
+        }
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path in self.REDIRECTS:
+                status, location = self.REDIRECTS[url.path]
+                self.send_response(status)
+                self.send_header("Location", f"{location}?{url.query}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            objid = urllib.parse.parse_qs(url.query)["objid"][0]
+            server = self.server
+            with server.lock:
+                server.requests.append(objid)
+                server.clients.add(self.client_address)
+                fail = server.failures.get(objid, 0)
+                if fail:
+                    server.failures[objid] -= 1
+            if objid.endswith("missing"):
+                status, body = 404, b"not found"
+            elif fail:
+                status, body = 500, b"error"
+            else:
+                status, body = 200, f"FITS {objid}".encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.clients = set()
+        self.server.failures = {}
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.downloader = FITSDownloader(
+            url=f"http://127.0.0.1:{self.server.server_port}/lcextract",
+            concurrency=4,
+            retries=2,
+            backoff=0,
+        )
+        self.addCleanup(self.downloader.close)
+
+    def fetch(self, superwasp_id):
+        with tempfile.TemporaryFile() as fits_file:
+            return self.downloader.fetch(superwasp_id, fits_file).read()
+
+    def test_fetch(self):
+        self.assertEqual(
+            self.fetch("1SWASPJ000000.00+000000.0"), b"FITS 1SWASP J000000.00+000000.0"
+        )
+
+    def test_fetch_retries_server_errors(self):
+        self.server.failures["1SWASP J000000.00+000000.0"] = 2
+        self.assertEqual(
+            self.fetch("1SWASPJ000000.00+000000.0"), b"FITS 1SWASP J000000.00+000000.0"
+        )
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_fetch_does_not_retry_client_errors(self):
+        with self.assertRaises(DownloadError):
+            self.fetch("1SWASPmissing")
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_fetch_follows_redirects(self):
+        downloader = FITSDownloader(
+            url=f"http://127.0.0.1:{self.server.server_port}/moved/lcextract"
+        )
+        self.addCleanup(downloader.close)
+        with tempfile.TemporaryFile() as fits_file:
+            self.assertEqual(
+                downloader.fetch("1SWASPJ000000.00+000000.0", fits_file).read(),
+                b"FITS 1SWASP J000000.00+000000.0",
+            )
+        # The redirect stays on the same host, so it reuses the connection
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_fetch_stops_redirect_loops(self):
+        downloader = FITSDownloader(
+            url=f"http://127.0.0.1:{self.server.server_port}/loop",
+            retries=0,
+        )
+        self.addCleanup(downloader.close)
+        with tempfile.TemporaryFile() as fits_file:
+            with self.assertRaises(http.client.HTTPException):
+                downloader.fetch("1SWASPJ000000.00+000000.0", fits_file)
+
+    def test_download(self):
+        superwasp_ids = [f"1SWASPJ0000{i:02}.00+000000.0" for i in range(20)]
+        results = {
+            superwasp_id: (fits_file and fits_file.read(), error)
+            for superwasp_id, fits_file, error in self.downloader.download(
+                superwasp_ids + ["1SWASPmissing"]
+            )
+        }
+        self.assertIsInstance(results.pop("1SWASPmissing")[1], DownloadError)
+        self.assertEqual(
+            results,
+            {
+                superwasp_id: (
+                    f"FITS {superwasp_id.replace('1SWASP', '1SWASP ')}".encode(),
+                    None,
+                )
+                for superwasp_id in superwasp_ids
+            },
+        )
+
+    def test_download_reuses_connections(self):
+        for batch in range(3):
+            superwasp_ids = [f"1SWASPJ00{batch}0{i:02}.00+000000.0" for i in range(10)]
+            self.assertEqual(
+                [error for _, _, error in self.downloader.download(superwasp_ids)],
+                [None] * 10,
+            )
+        # Each of the 4 threads keeps its connection open between batches
+        self.assertLessEqual(len(self.server.clients), 4)
+
+    @override_settings(FITS_DOWNLOAD_CLAIM_SIZE=2)
+    @mock.patch.object(StagedFITSFile, "update_index")
+    def test_download_fits_files_claims_in_batches(self, update_index):
+        with mock.patch.object(
+            Star, "claim_fits_downloads", return_value={}
+        ) as claim_fits_downloads:
+            download_fits_files([1, 2, 3, 4, 5])
+        self.assertEqual(
+            [call.args for call in claim_fits_downloads.call_args_list],
+            [([1, 2],), ([3, 4],), ([5],)],
+        )
+        update_index.assert_called_once_with()
+
+
+def make_classifications(votes):
+    """
+    Builds a frame of classifications, as prepare_data_release reads them from the
+    export, from a dict mapping subject IDs to lists of (classification, period
+    certainty) votes.
+    """
+    rows = [
+        (subject_id, classification, f"{classification} {certainty}", f"user{i}")
+        for subject_id, subject_votes in votes.items()
+        for i, (classification, certainty) in enumerate(subject_votes)
+    ]
+    return pandas.DataFrame(
+        rows, columns=["subject_id", "classification", "period_certainty", "user_name"]
+    )
+
+
+class AggregateVotesTestCase(SimpleTestCase):
+    def test_aggregate_votes(self):
+        aggregated_classifications = aggregate_votes(
+            make_classifications(
+                {
+                    1: [
+                        ("Pulsator", "Correct period"),
+                        ("Pulsator", "Wrong period"),
+                        ("Pulsator", "Wrong period"),
+                    ],
+                    # Ties go to the first of half correct, correct and wrong
+                    2: [
+                        ("EW type", "Half correct period"),
+                        ("EW type", "Correct period"),
+                        ("Rotator", None),
+                    ],
+                    3: [("EA/EB type", "Wrong period")],
+                    # Rotators always have the correct period
+                    4: [("Rotator", "Wrong period")],
+                    # Junk wins ties, and junk subjects are left out
+                    5: [("Junk", None), ("Pulsator", "Correct period")],
+                }
+            )
+        )
+        self.assertEqual(
+            aggregated_classifications[
+                ["consensus class", "period certainty", "classification count"]
+            ].to_dict("index"),
+            {
+                1: {
+                    "consensus class": "Pulsator",
+                    "period certainty": "Wrong period",
+                    "classification count": 3,
+                },
+                2: {
+                    "consensus class": "EW type",
+                    "period certainty": "Half correct period",
+                    "classification count": 3,
+                },
+                3: {
+                    "consensus class": "EA/EB type",
+                    "period certainty": "Wrong period",
+                    "classification count": 1,
+                },
+                4: {
+                    "consensus class": "Rotator",
+                    "period certainty": "Correct period",
+                    "classification count": 1,
+                },
+            },
+        )
+
+
+def make_export(rows, first_id=0):
+    lines = ["classification_id,user_name,workflow_id,annotations,subject_ids"]
+    for i, (user_name, workflow_id, values, subject_id) in enumerate(rows, first_id):
+        annotations = json.dumps(
+            [{"task": f"T{n}", "value": value} for n, value in enumerate(values)]
+        ).replace('"', '""')
+        lines.append(f'{i},{user_name},{workflow_id},"{annotations}",{subject_id}')
+    return io.StringIO("\n".join(lines) + "\n")
+
+
+class ReadClassificationExportTestCase(SimpleTestCase):
+    def test_read_classification_export(self):
+        export = make_export(
+            [
+                ("alice", 1, ["Pulsator", "Correct period"], 10),
+                ("bob", 1, ["EW type"], 10),
+                ("alice", 2, ["Junk", "Correct period"], 11),
+                # Repeat classifications, in the same chunk and in later ones
+                ("alice", 1, ["EW type", "Wrong period"], 10),
+                ("bob", 1, ["Rotator"], 10),
+                ("carol", 1, ["Real"], 11),
+                ("carol", 3, ["Pulsator"], 11),
+                ("alice", 1, ["Rotator"], 11),
+            ]
+        )
+        classifications = read_classification_export(export, (1, 2), chunk_size=2)
+        self.assertEqual(classifications["subject_id"].dtype, numpy.int32)
+        for column in ("classification", "period_certainty", "user_name"):
+            self.assertEqual(classifications[column].dtype, "category")
+        self.assertEqual(
+            classifications.astype(object).values.tolist(),
+            [
+                [0, 10, "Pulsator", "Pulsator Correct period", "alice"],
+                [1, 10, "EW type", "EW type None", "bob"],
+                [2, 11, "Junk", "Junk Wrong period", "alice"],
+            ],
+        )
+        self.assertEqual(
+            aggregate_votes(classifications)["consensus class"].to_dict(),
+            {10: "Pulsator"},
+        )
+
+
+class ClassificationStoreTestCase(SimpleTestCase):
+    def setUp(self):
+        self.store_dir = tempfile.TemporaryDirectory()
+        self.first_export = make_export(
+            [
+                ("alice", 1, ["Pulsator", "Correct period"], 10),
+                ("bob", 1, ["EW type"], 10),
+            ]
+        )
+        # Later exports include every earlier classification
+        self.second_export = make_export(
+            [
+                ("alice", 1, ["Pulsator", "Correct period"], 10),
+                ("bob", 1, ["EW type"], 10),
+                ("carol", 1, ["Rotator"], 10),
+                ("alice", 1, ["Rotator"], 10),
+                ("alice", 2, ["Junk", "Correct period"], 11),
+            ]
+        )
+
+    def tearDown(self):
+        self.store_dir.cleanup()
+
+    def append(self, store, export, export_date):
+        store.append(
+            read_classification_export(
+                export, (1, 2), after_classification_id=store.last_classification_id
+            ),
+            datetime.datetime(*export_date, tzinfo=datetime.timezone.utc),
+        )
+
+    def test_append(self):
+        store = ClassificationStore(self.store_dir.name)
+        self.assertIsNone(store.latest_export_date)
+        self.append(store, self.first_export, (2024, 1, 1))
+        self.append(store, self.second_export, (2024, 2, 1))
+
+        # Reopened from disk
+        store = ClassificationStore(self.store_dir.name)
+        self.assertEqual([partition["rows"] for partition in store.partitions], [2, 3])
+        self.assertEqual(store.last_classification_id, 4)
+        self.assertEqual(store.latest_export_date.month, 2)
+        classifications = store.load()
+        self.assertEqual(classifications["user_name"].dtype, "category")
+        # alice's repeat classification of subject 10 is dropped
+        self.assertEqual(
+            classifications.astype(object).values.tolist(),
+            [
+                [0, 10, "Pulsator", "Pulsator Correct period", "alice"],
+                [1, 10, "EW type", "EW type None", "bob"],
+                [2, 10, "Rotator", "Rotator Correct period", "carol"],
+                [4, 11, "Junk", "Junk Wrong period", "alice"],
+            ],
+        )
+        self.second_export.seek(0)
+        self.assertEqual(
+            aggregate_votes(
+                read_classification_export(self.second_export, (1, 2))
+            ).to_dict(),
+            aggregate_votes(classifications).to_dict(),
+        )
+
+    def test_load(self):
+        store = ClassificationStore(self.store_dir.name)
+        self.append(store, self.first_export, (2024, 1, 1))
+        self.append(store, self.second_export, (2024, 2, 1))
+        classifications = store.load(
+            ["subject_id", "classification"],
+            export_date=datetime.datetime(2024, 1, 15, tzinfo=datetime.timezone.utc),
+        )
+        self.assertEqual(
+            list(classifications.columns), ["subject_id", "classification"]
+        )
+        self.assertEqual(
+            classifications["classification"].tolist(), ["Pulsator", "EW type"]
+        )
+
+    def test_version(self):
+        store = ClassificationStore(self.store_dir.name)
+        self.append(store, self.first_export, (2024, 1, 1))
+        with mock.patch(
+            "starcatalogue.classifications.CLASSIFICATION_STORE_VERSION", 2
+        ):
+            store = ClassificationStore(self.store_dir.name)
+            self.assertEqual(store.partitions, [])
+            self.assertEqual(len(store.load()), 0)
+
+
+class ImportAggregatedClassificationsTestCase(TestCase):
+    def test_import(self):
+        with mock.patch("starcatalogue.signals.prepare_data_release"):
+            data_release = DataRelease.objects.create(version=1.0)
+        star = Star.objects.create(superwasp_id="1SWASPJ000000.00+000000.0")
+        lightcurve = FoldedLightcurve.objects.create(
+            star=star, period_number=1, period_length=500.0, sigma=1.0, chi_squared=1.0
+        )
+        aggregated_classifications = aggregate_votes(
+            make_classifications(
+                {
+                    1: [("Pulsator", "Correct period")],
+                    2: [("Rotator", None)],
+                    3: [("EW type", "Correct period")],
+                }
+            )
+        ).join(
+            pandas.DataFrame(
+                {
+                    "SWASP ID": [star.superwasp_id] + ["1SWASPJ000000.00+000000.1"] * 2,
+                    "Period Number": [1, 1, 2],
+                    "Original Period": [1000.0, 1000.0, 2000.0],
+                    "Sigma": 1.0,
+                    "Chi Squared": 1.0,
+                },
+                index=[1, 2, 3],
+            )
+        )
+        import_aggregated_classifications(
+            data_release, aggregated_classifications, chunk_size=2
+        )
+        data_release.refresh_from_db()
+        self.assertEqual(data_release.progress, 100.0)
+        self.assertEqual(Star.objects.count(), 2)
+        lightcurve.refresh_from_db()
+        self.assertEqual(lightcurve.updated_period_length, 1000.0)
+        self.assertEqual(
+            dict(
+                ZooniverseSubject.objects.values_list(
+                    "zooniverse_id", "lightcurve__period_number"
+                )
+            ),
+            {1: 1, 2: 1, 3: 2},
+        )
+        self.assertEqual(
+            AggregatedClassification.objects.filter(
+                data_release=data_release
+            ).count(),
+            3,
+        )
+
+
+class IncrementalReleaseTestCase(TestCase):
+    def test_carry_forward_classifications(self):
+        with mock.patch("starcatalogue.signals.prepare_data_release"):
+            base_release = DataRelease.objects.create(
+                version=1.0,
+                aggregation_finished=timezone.now(),
+                last_classification_id=10,
+            )
+            data_release = DataRelease.objects.create(version=2.0, incremental=True)
+        self.assertEqual(data_release.get_incremental_base(), base_release)
+
+        star = Star.objects.create(superwasp_id="1SWASPJ000000.00+000000.0")
+        for subject_id in (1, 2):
+            lightcurve = FoldedLightcurve.objects.create(
+                star=star, period_number=subject_id
+            )
+            ZooniverseSubject.objects.create(
+                zooniverse_id=subject_id, lightcurve=lightcurve
+            )
+            AggregatedClassification.objects.create(
+                data_release=base_release,
+                lightcurve=lightcurve,
+                classification=AggregatedClassification.PULSATOR,
+                period_uncertainty=AggregatedClassification.CERTAIN,
+                classification_count=1,
+            )
+
+        classifications = make_classifications(
+            {1: [("Pulsator", "Correct period")], 2: [("EW type", "Correct period")]}
+        ).assign(classification_id=[5, 11])
+        changed_subject_ids = get_changed_subjects(
+            classifications, base_release.last_classification_id
+        )
+        self.assertEqual(changed_subject_ids.tolist(), [2])
+        with mock.patch(
+            "starcatalogue.releases.update_progress", wraps=update_progress
+        ) as progress:
+            self.assertEqual(
+                carry_forward_classifications(
+                    base_release,
+                    data_release,
+                    changed_subject_ids,
+                    chunk_size=1,
+                    progress_range=(50, 90),
+                ),
+                1,
+            )
+        # Progress is reported after each chunk
+        self.assertEqual(progress.call_count, 2)
+        data_release.refresh_from_db()
+        self.assertEqual(data_release.progress, 90)
+        self.assertEqual(
+            list(
+                AggregatedClassification.objects.filter(
+                    data_release=data_release
+                ).values_list("lightcurve__zooniversesubject__zooniverse_id", flat=True)
+            ),
+            [1],
+        )
+
+
+class AssetLocationTestCase(SimpleTestCase):
+    # SimpleTestCase fails on any database query, so these also check that the
+    # locations are read without touching the database or the result backend
+    def test_missing_assets(self):
+        star = Star(superwasp_id="1SWASPJ123456.78-012345.6")
+        self.assertIsNone(star.image_location)
+        self.assertIsNone(star.json_location)
+        self.assertIsNone(star.fits)
+
+    def test_outdated_image_is_still_shown(self):
+        star = Star(
+            superwasp_id="1SWASPJ123456.78-012345.6",
+            image_file="sources/1SWASPJ123456.78-012345.6/v0.1_lightcurve.png",
+            image_version=0.1,
+        )
+        self.assertTrue(star.image_outdated)
+        self.assertEqual(star.image_location, star.image_file.url)
+
+    def test_outdated_magnitudes_are_still_shown(self):
+        star = Star(
+            superwasp_id="1SWASPJ123456.78-012345.6",
+            fits_file="sources/1SWASPJ123456.78-012345.6.fits",
+            _mean_magnitude=12.0,
+            stats_version=0.1,
+        )
+        self.assertEqual(star.mean_magnitude, 12.0)
+        self.assertIsNone(star.amplitude)
+
+
+class StarSetLocationsTestCase(TestCase):
+    def test_set_locations(self):
+        superwasp_ids = StarCoordsTestCase.superwasp_ids
+        Star.objects.bulk_create(
+            [Star(superwasp_id=superwasp_id) for superwasp_id in superwasp_ids]
+        )
+        self.assertEqual(Star.set_locations(limit=2, batch_size=1), 2)
+        self.assertEqual(Star.set_locations(batch_size=2), 1)
+        self.assertEqual(Star.set_locations(), 0)
+        for star in Star.objects.all():
+            self.assertAlmostEqual(star.location[0], star.coords.ra.deg, places=6)
+            self.assertAlmostEqual(star.location[1], star.coords.dec.deg, places=6)
+
+    def test_set_locations_skips_malformed_ids(self):
+        Star.objects.bulk_create(
+            [
+                Star(superwasp_id="1SWASPJ000000.1+320054.7"),
+                Star(superwasp_id=StarCoordsTestCase.superwasp_ids[0]),
+            ]
+        )
+        with self.assertLogs("starcatalogue.models", "WARNING"):
+            self.assertEqual(Star.set_locations(batch_size=1), 1)
+        self.assertEqual(
+            list(Star.objects.filter(location=None).values_list("superwasp_id")),
+            [("1SWASPJ000000.1+320054.7",)],
+        )
+
+
+class LightcurveImageGenerationTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.star = Star.objects.create(
+            superwasp_id="1SWASPJ000000.00+000000.0",
+            fits_file="sources/1SWASPJ000000.00+000000.0.fits",
+        )
+        self.lightcurves = FoldedLightcurve.objects.bulk_create(
+            [
+                FoldedLightcurve(
+                    star=self.star,
+                    period_number=period_number,
+                    period_length=period_number * 50000.0,
+                    sigma=1.0,
+                    chi_squared=1.0,
+                )
+                for period_number in (1, 2, 3)
+            ]
+        )
+        rng = numpy.random.default_rng(0)
+        hjd = numpy.sort(rng.uniform(2453005.5, 2453105.5, 500))
+        self.photometry = Photometry.from_arrays(
+            hjd, Star.outlier_clip(rng.normal(100, 5, 500))
+        )
+
+    def get_statuses(self):
+        return list(
+            FoldedLightcurve.objects.order_by("period_number").values_list(
+                "image_status", flat=True
+            )
+        )
+
+    @mock.patch("starcatalogue.models.generate_star_lightcurve_images")
+    def test_queue_lightcurve_images(self, task):
+        task_id = uuid.uuid4()
+        task.delay.return_value.id = task_id
+        self.assertTrue(self.star.queue_lightcurve_images())
+        self.assertEqual(self.get_statuses(), [FoldedLightcurve.ASSET_QUEUED] * 3)
+        self.assertEqual(
+            set(
+                FoldedLightcurve.objects.values_list(
+                    "images_celery_task_id", flat=True
+                )
+            ),
+            {task_id},
+        )
+        # Already claimed, so not queued again
+        self.assertFalse(self.star.queue_lightcurve_images())
+        task.delay.assert_called_once_with(self.star.id)
+
+    @mock.patch("starcatalogue.models.generate_star_images")
+    @mock.patch("starcatalogue.models.generate_star_lightcurve_images")
+    def test_queue_image_generations(self, task, star_task):
+        from vespa.celery import queue_image_generations
+
+        task.delay.return_value.id = uuid.uuid4()
+        star_task.apply_async.return_value.id = uuid.uuid4()
+        queue_image_generations()
+        queue_image_generations()
+        # One task for all of the star's lightcurves
+        task.delay.assert_called_once_with(self.star.id)
+
+    @mock.patch.object(Star, "photometry", new_callable=mock.PropertyMock)
+    def test_generate_star_lightcurve_images(self, photometry):
+        photometry.return_value = self.photometry
+        generate_star_lightcurve_images(self.star.id)
+        photometry.assert_called_once()
+        self.assertEqual(self.get_statuses(), [FoldedLightcurve.ASSET_COMPLETE] * 3)
+        for lightcurve in FoldedLightcurve.objects.all():
+            self.assertFalse(lightcurve.image_outdated)
+            self.assertTrue(os.path.exists(lightcurve.image_file.path))
+            self.assertTrue(os.path.exists(lightcurve.thumbnail_file.path))
+
+    @mock.patch.object(Star, "photometry", new_callable=mock.PropertyMock)
+    @mock.patch("starcatalogue.tasks.save_lightcurve_images")
+    def test_generate_star_lightcurve_images_failure(self, save_images, photometry):
+        def save_or_fail(lightcurve, photometry):
+            if lightcurve.period_number == 2:
+                raise RuntimeError("Rendering failed")
+            save_lightcurve_images(lightcurve, photometry)
+
+        save_images.side_effect = save_or_fail
+        photometry.return_value = self.photometry
+        with self.assertLogs("starcatalogue.tasks", "ERROR"):
+            generate_star_lightcurve_images(self.star.id)
+        self.assertEqual(
+            self.get_statuses(),
+            [
+                FoldedLightcurve.ASSET_COMPLETE,
+                FoldedLightcurve.ASSET_FAILED,
+                FoldedLightcurve.ASSET_COMPLETE,
+            ],
+        )
+
+
+class StagedFITSFileTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.staging_root = StagedFITSFile.get_staging_root()
+
+    def stage(self, batch, superwasp_id):
+        batch_dir = self.staging_root / batch
+        batch_dir.mkdir(parents=True, exist_ok=True)
+        (batch_dir / f"{superwasp_id}.fits").write_bytes(b"FITS")
+
+    def test_update_index(self):
+        self.stage("batch_1", "1SWASPJ000000.00+000000.0")
+        self.stage("batch_1", "1SWASPJ000000.00+000000.1")
+        self.assertEqual(StagedFITSFile.update_index(), 2)
+
+        self.stage("batch_1", "1SWASPJ000000.00+000000.2")
+        self.stage("batch_2", "1SWASPJ000000.00+000000.3")
+        # Only the new batch is listed unless rescanning
+        self.assertEqual(StagedFITSFile.update_index(), 1)
+        (self.staging_root / "batch_1" / "1SWASPJ000000.00+000000.0.fits").unlink()
+        self.assertEqual(StagedFITSFile.update_index(rescan=True), 1)
+        self.assertEqual(
+            set(StagedFITSFile.objects.values_list("superwasp_id", flat=True)),
+            {
+                "1SWASPJ000000.00+000000.1",
+                "1SWASPJ000000.00+000000.2",
+                "1SWASPJ000000.00+000000.3",
+            },
+        )
+
+    def test_update_index_counts_stars_staged_twice_once(self):
+        self.stage("batch_1", "1SWASPJ000000.00+000000.0")
+        self.assertEqual(StagedFITSFile.update_index(), 1)
+        self.stage("batch_2", "1SWASPJ000000.00+000000.0")
+        self.stage("batch_2", "1SWASPJ000000.00+000000.1")
+        self.assertEqual(StagedFITSFile.update_index(), 1)
+        self.assertEqual(
+            StagedFITSFile.objects.get(superwasp_id="1SWASPJ000000.00+000000.0").batch,
+            "batch_1",
+        )
+
+    def test_ingest(self):
+        superwasp_id = "1SWASPJ000000.00+000000.0"
+        self.stage("batch_1", superwasp_id)
+        StagedFITSFile.update_index()
+        star = Star.objects.create(superwasp_id=superwasp_id)
+        staged = StagedFITSFile.objects.get(superwasp_id=superwasp_id)
+        self.assertTrue(staged.ingest(star))
+        self.assertFalse(staged.path.exists())
+        self.assertFalse(StagedFITSFile.objects.exists())
+        star.refresh_from_db()
+        self.assertEqual(star.fits_status, Star.ASSET_COMPLETE)
+        with star.fits_file.open("rb") as fits_f:
+            self.assertEqual(fits_f.read(), b"FITS")
+
+
+class StarListViewOrderingTestCase(SimpleTestCase):
+    def get_page_sql(self, query_string):
+        view = StarListView()
+        qs = view.get_queryset(
+            params=QueryDict(query_string),
+            data_release=DataRelease(id=1, version=1.0),
+        )
+        return str(qs[:20].values_list("id", flat=True).query)
+
+    def test_distance_ordering_uses_knn_operator(self):
+        sql = self.get_page_sql("search=10d 20d")
+        self.assertRegex(sql, r'ORDER BY "[a-z_]+"\."location"<->spoint\(.*\) ASC')
+
+    def test_other_orderings_use_catalogue_fields(self):
+        sql = self.get_page_sql("sort=lightcurve__star___amplitude&order=desc")
+        self.assertIn('ORDER BY "starcatalogue_catalogueentry"."amplitude" DESC', sql)
+
+
+class ExportRecordsTestCase(SimpleTestCase):
+    def get_values(self):
+        return pandas.DataFrame.from_records(
+            [
+                (
+                    "1SWASPJ123456.78-012345.6",
+                    1234.5,
+                    11.5,
+                    12.5,
+                    12.0,
+                    1.0,
+                    AggregatedClassification.EW,
+                    7,
+                    AggregatedClassification.HALF,
+                    0.1,
+                    2.0,
+                    "sources/1SWASPJ123456.78-012345.6/v0.92_star.fits",
+                    "sources/1SWASPJ123456.78-012345.6/v0.3_lightcurve.json",
+                    "",
+                    "sources/1SWASPJ123456.78-012345.6/v1.0_lightcurve-1.png",
+                ),
+            ],
+            columns=EXPORT_QUERYSET_FIELDS,
+        )
+
+    def test_gen_export_records_frame(self):
+        record = gen_export_records_frame(self.get_values()).iloc[0]
+        self.assertEqual(list(record.index), list(EXPORT_DATA_DESCRIPTION))
+        star = Star(superwasp_id="1SWASPJ123456.78-012345.6")
+        self.assertEqual(record["RA"], star.ra)
+        self.assertEqual(record["Dec"], star.dec)
+        self.assertEqual(record["Classification"], "EW")
+        self.assertEqual(record["Folding flag"], "Half")
+        self.assertTrue(record["FITS URL"].startswith("https://"))
+        self.assertEqual(record["Unfolded plot URL"], "")
+
+    def test_write_export_fits(self):
+        frame = gen_export_records_frame(self.get_values(), sexagesimal=False)
+        fits_file = io.BytesIO()
+        self.assertEqual(write_export_fits([frame, frame], fits_file), 2)
+        fits_file.seek(0)
+        with fits.open(fits_file) as hdus:
+            table = hdus[1].data
+            self.assertEqual(list(table.columns.names), list(EXPORT_DATA_DESCRIPTION))
+            self.assertEqual(len(table), 2)
+            self.assertEqual(table["Classification count"][1], 7)
+            self.assertAlmostEqual(table["Dec"][0], -1.396)
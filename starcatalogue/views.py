@@ -1,11 +1,11 @@
-from decimal import Decimal
-
 from astropy.coordinates import SkyCoord
 from astropy.coordinates.name_resolve import NameResolveError
 from astropy import units as u
 
-from django.db.models import Q
+from django.core.paginator import Paginator
+from django.db.models import Prefetch, Q
 from django.shortcuts import get_object_or_404
+from django.utils.functional import cached_property
 from django.views.generic.list import ListView
 from django.views.generic import DetailView
 
@@ -13,12 +13,72 @@ from starcatalogue.models import (
     DataRelease,
     Star,
     AggregatedClassification,
+    CatalogueEntry,
+    FoldedLightcurve,
 )
+from starcatalogue.caching import get_results_cache, results_cache_key
 from starcatalogue.fields import Distance
 
 
+class CachedResultsPaginator(Paginator):
+    """
+    Paginator which caches the result count and the IDs on each page, so repeated
+    searches don't need to run the full query again.
+    """
+
+    def __init__(self, object_list, per_page, cache_key, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.cache_key = cache_key
+
+    @cached_property
+    def count(self):
+        cache = get_results_cache()
+        count = cache.get(f"{self.cache_key}:count")
+        if count is None:
+            count = super().count
+            cache.set(f"{self.cache_key}:count", count)
+        return count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+        cache = get_results_cache()
+        page_key = f"{self.cache_key}:page:{self.per_page}:{number}"
+        page_ids = cache.get(page_key)
+        if page_ids is None:
+            page_ids = list(self.object_list[bottom:top].values_list("id", flat=True))
+            cache.set(page_key, page_ids)
+        page_objects = {obj.id: obj for obj in self.object_list.filter(id__in=page_ids)}
+        return self._get_page(
+            [page_objects[i] for i in page_ids if i in page_objects], number, self
+        )
+
+
 class StarListView(ListView):
     paginate_by = 20
+    template_name = "starcatalogue/aggregatedclassification_list.html"
+    # Columns used when rendering a page of results. Everything else is deferred so
+    # that each page is read from the catalogue table alone. Only the images are
+    # looked up on the lightcurves, by primary key.
+    list_fields = (
+        "superwasp_id",
+        "lightcurve",
+        "period_length",
+        "classification",
+        "period_uncertainty",
+        "classification_count",
+        "mean_magnitude",
+        "amplitude",
+    )
+    list_lightcurve_fields = (
+        "image_file",
+        "thumbnail_file",
+        "image_version",
+        "zooniversesubject__image_location",
+    )
 
     def get_queryset(self, params=None, data_release=None):
         if params is None:
@@ -26,19 +86,16 @@ class StarListView(ListView):
 
         if data_release is None:
             data_release = DataRelease.get_latest()
+        self.data_release = data_release
 
-        qs = AggregatedClassification.objects.filter(data_release=data_release)
-
-        qs = qs.filter(
-            ~Q(lightcurve__sigma=Decimal("NaN"))
-            & ~Q(lightcurve__chi_squared=Decimal("NaN"))
-            & ~Q(lightcurve__period_length=Decimal("NaN"))
-        )
+        # Only visible classifications are copied into the catalogue, so there's no
+        # need to exclude NaN periods etc. here.
+        qs = CatalogueEntry.objects.filter(data_release=data_release)
 
         try:
             self.min_period = float(params.get("min_period", None))
             if self.min_period:
-                qs = qs.filter(lightcurve__period_length__gte=self.min_period)
+                qs = qs.filter(period_length__gte=self.min_period)
             else:
                 # To ensure it's None rather than ''
                 self.min_period = None
@@ -48,7 +105,7 @@ class StarListView(ListView):
         try:
             self.max_period = float(params.get("max_period", None))
             if self.max_period:
-                qs = qs.filter(lightcurve__period_length__lte=self.max_period)
+                qs = qs.filter(period_length__lte=self.max_period)
             else:
                 # To ensure it's None rather than ''
                 self.max_period = None
@@ -78,9 +135,7 @@ class StarListView(ListView):
         try:
             self.min_magnitude = float(params.get("min_magnitude", None))
             if self.min_magnitude:
-                qs = qs.filter(
-                    lightcurve__star___mean_magnitude__gte=self.min_magnitude
-                )
+                qs = qs.filter(mean_magnitude__gte=self.min_magnitude)
             else:
                 # To ensure it's None rather than ''
                 self.min_magnitude = None
@@ -90,9 +145,7 @@ class StarListView(ListView):
         try:
             self.max_magnitude = float(params.get("max_magnitude", None))
             if self.max_magnitude:
-                qs = qs.filter(
-                    lightcurve__star___mean_magnitude__lte=self.max_magnitude
-                )
+                qs = qs.filter(mean_magnitude__lte=self.max_magnitude)
             else:
                 # To ensure it's None rather than ''
                 self.max_magnitude = None
@@ -102,7 +155,7 @@ class StarListView(ListView):
         try:
             self.min_amplitude = float(params.get("min_amplitude", None))
             if self.min_amplitude:
-                qs = qs.filter(lightcurve__star___amplitude__gte=self.min_amplitude)
+                qs = qs.filter(amplitude__gte=self.min_amplitude)
             else:
                 # To ensure it's None rather than ''
                 self.min_amplitude = None
@@ -112,7 +165,7 @@ class StarListView(ListView):
         try:
             self.max_amplitude = float(params.get("max_amplitude", None))
             if self.max_amplitude:
-                qs = qs.filter(lightcurve__star___amplitude__lte=self.max_amplitude)
+                qs = qs.filter(amplitude__lte=self.max_amplitude)
             else:
                 # To ensure it's None rather than ''
                 self.max_amplitude = None
@@ -204,27 +257,28 @@ class StarListView(ListView):
             else:
                 qs = qs.filter(
                     Q(
-                        lightcurve__star__location__inradius=(
+                        location__inradius=(
                             (self.coords.ra.to_value(), self.coords.dec.to_value()),
                             self.search_radius,
                         )
                     )
                 )
 
-        sort_fields = (
-            "distance",
-            "lightcurve__star__superwasp_id",
-            "lightcurve__period_length",
-            "classification",
-            "classification_count",
-            "lightcurve__star___mean_magnitude",
-            "lightcurve__star___max_magnitude",
-            "lightcurve__star___min_magnitude",
-            "lightcurve__star___amplitude",
-        )
+        # Maps sort parameters to catalogue fields
+        sort_fields = {
+            "distance": "distance",
+            "lightcurve__star__superwasp_id": "superwasp_id",
+            "lightcurve__period_length": "period_length",
+            "classification": "classification",
+            "classification_count": "classification_count",
+            "lightcurve__star___mean_magnitude": "mean_magnitude",
+            "lightcurve__star___max_magnitude": "max_magnitude",
+            "lightcurve__star___min_magnitude": "min_magnitude",
+            "lightcurve__star___amplitude": "amplitude",
+        }
         self.sort = params.get("sort", None)
         if self.sort not in sort_fields:
-            self.sort = sort_fields[0]
+            self.sort = "distance"
 
         self.order = params.get("order", None)
         if self.order == "desc":
@@ -237,20 +291,66 @@ class StarListView(ListView):
             self.coords = SkyCoord(0, 0, unit=u.deg)
 
         if self.coords is not None:
-            qs = qs.annotate(
-                distance=Distance(
-                    "lightcurve__star__location",
-                    (
-                        self.coords.ra.to_value(),
-                        self.coords.dec.to_value(),
-                    ),
+            distance = Distance(
+                "location",
+                (
+                    self.coords.ra.to_value(),
+                    self.coords.dec.to_value(),
                 ),
-            ).order_by("{}{}".format(order_prefix, self.sort))
-
-        self.result_count = qs.count()
+            )
+            qs = qs.annotate(distance=distance)
+            if self.sort == "distance":
+                # Order by the <-> expression itself rather than the annotation, so
+                # PostgreSQL can walk the location index in nearest-neighbour order
+                # and stop once it has a page of results.
+                qs = qs.order_by(distance.desc() if order_prefix else distance.asc())
+            else:
+                qs = qs.order_by(order_prefix + sort_fields[self.sort])
 
         return qs
 
+    def paginate_queryset(self, queryset, page_size):
+        lightcurves = FoldedLightcurve.objects.select_related(
+            "zooniversesubject"
+        ).only(*self.list_lightcurve_fields)
+        return super().paginate_queryset(
+            queryset.only(*self.list_fields).prefetch_related(
+                Prefetch("lightcurve", queryset=lightcurves)
+            ),
+            page_size,
+        )
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return CachedResultsPaginator(
+            queryset, per_page, cache_key=self.get_results_cache_key(), **kwargs
+        )
+
+    def get_results_cache_key(self):
+        return results_cache_key(
+            self.data_release.id if self.data_release else None,
+            self.min_period,
+            self.max_period,
+            self.min_magnitude,
+            self.max_magnitude,
+            self.min_amplitude,
+            self.max_amplitude,
+            self.certain_period,
+            self.uncertain_period,
+            self.half_period,
+            self.min_classifications,
+            self.max_classifications,
+            self.type_pulsator,
+            self.type_eaeb,
+            self.type_ew,
+            self.type_rotator,
+            self.type_unknown,
+            self.search,
+            self.search_radius,
+            (self.coords.ra.deg, self.coords.dec.deg) if self.coords else None,
+            self.sort,
+            self.order,
+        )
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["min_period"] = self.min_period
@@ -274,8 +374,8 @@ class StarListView(ListView):
         context["coords"] = self.coords
         context["sort"] = self.sort
         context["order"] = self.order
-        context["result_count"] = self.result_count
-        context["data_release"] = DataRelease.get_latest()
+        context["result_count"] = context["paginator"].count
+        context["data_release"] = self.data_release
 
         return context
 
@@ -1,5 +1,4 @@
 import os
-from decimal import Decimal
 
 from celery import Celery
 
@@ -26,6 +25,10 @@ app.autodiscover_tasks()
 
 @app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
+    sender.add_periodic_task(
+        settings.PERIODIC_TASK_INTERVAL,
+        queue_fits_downloads.s(),
+    )
     sender.add_periodic_task(
         settings.PERIODIC_TASK_INTERVAL,
         queue_image_generations.s(),
@@ -52,73 +55,85 @@ def setup_zooniverse(sender, **kwargs):
         )
 
 
+@app.task
+def queue_fits_downloads():
+    from starcatalogue.models import StagedFITSFile, Star
+
+    # Downloads use files staged in new batch directories, once they're indexed
+    StagedFITSFile.update_index()
+    for star in (
+        Star.objects.filter(fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS)
+        .filter(Q(fits_file=None) | Q(fits_file=""))
+        .exclude(Star.asset_in_progress("fits_status", "fits_celery_started"))[:1000]
+    ):
+        star.queue_fits_download()
+
+
 @app.task
 def queue_image_generations():
     from starcatalogue.models import Star, FoldedLightcurve
 
-    for star in Star.objects.filter(
-        fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
-    ).filter(Q(image_version=None) | Q(image_version__lt=Star.CURRENT_IMAGE_VERSION))[
-        :1000
-    ]:
-        star.get_image_location()
+    for star in (
+        Star.objects.filter(fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS)
+        .filter(
+            Q(image_version=None) | Q(image_version__lt=Star.CURRENT_IMAGE_VERSION)
+        )
+        .exclude(Star.asset_in_progress("image_status", "image_celery_started"))[
+            :1000
+        ]
+    ):
+        star.queue_images()
 
-    for lightcurve in (
-        FoldedLightcurve.objects.filter(
+    # Each star's lightcurves are rendered together, so queue stars rather than
+    # individual lightcurves
+    for star in Star.objects.filter(
+        id__in=FoldedLightcurve.objects.filter(
             star__fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
         )
-        .filter(
-            Q(image_version=None)
-            | Q(image_version__lt=FoldedLightcurve.CURRENT_IMAGE_VERSION)
+        .filter(FoldedLightcurve.needs_image())
+        .exclude(
+            FoldedLightcurve.asset_in_progress("image_status", "image_celery_started")
         )
-        .filter(
-            ~Q(sigma=Decimal("NaN"))
-            & ~Q(chi_squared=Decimal("NaN"))
-            & ~Q(period_length=Decimal("NaN"))
-        )[:1000]
+        .values("star_id")[:1000]
     ):
-        lightcurve.get_image_location()
+        star.queue_lightcurve_images()
 
 
 @app.task
 def queue_json_generations():
     from starcatalogue.models import Star, FoldedLightcurve
 
-    for star in Star.objects.filter(
-        fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
-    ).filter(Q(json_version=None) | Q(json_version__lt=Star.CURRENT_JSON_VERSION))[
-        :1000
-    ]:
-        star.get_json_location()
+    for star in (
+        Star.objects.filter(fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS)
+        .filter(Q(json_version=None) | Q(json_version__lt=Star.CURRENT_JSON_VERSION))
+        .exclude(Star.asset_in_progress("json_status", "json_celery_started"))[:1000]
+    ):
+        star.queue_json_files()
 
 
 @app.task
 def calculate_magnitudes():
     from starcatalogue.models import Star
 
-    for star in Star.objects.filter(
-        fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS
-    ).filter(
-        Q(fits_file__isnull=False)
-        & (
-            Q(_min_magnitude__isnull=True)
-            | Q(_max_magnitude__isnull=True)
-            | Q(_mean_magnitude__isnull=True)
-            | Q(stats_version__lt=Star.CURRENT_STATS_VERSION)
-            | Q(stats_version__isnull=True)
-        )
-    )[
-        :1000
-    ]:
-        star.calculate_magnitudes()
+    from starcatalogue.caching import invalidate_results_cache
+
+    star_ids = list(
+        Star.objects.filter(fits_error_count__lt=settings.FITS_DOWNLOAD_ATTEMPTS)
+        .filter(Star.needs_magnitudes())
+        .values_list("id", flat=True)[: settings.MAGNITUDE_UPDATE_LIMIT]
+    )
+    if sum(Star.update_magnitudes(star_ids)):
+        invalidate_results_cache()
 
 
 @app.task
 def set_locations():
     from starcatalogue.models import Star
 
-    for star in Star.objects.filter(location=None)[:1000]:
-        star.set_location()
+    from starcatalogue.caching import invalidate_results_cache
+
+    if Star.set_locations(limit=settings.LOCATION_BACKFILL_LIMIT):
+        invalidate_results_cache()
 
 
 @app.task
@@ -30,6 +30,12 @@ STATIC_URL = "/"
 
 MEDIA_ROOT = "/opt/vespa/media"
 
+CACHES["results"] = {
+    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+    "LOCATION": "/opt/vespa/cache/results",
+    "TIMEOUT": 3600,
+}
+
 CELERY_BROKER_URL = (
     f'amqp://{os.environ["CELERY_RABBITMQ_USER"]}:{os.environ["CELERY_RABBITMQ_PASS"]}'
     f'@{os.environ["CELERY_RABBITMQ_HOST"]}/{os.environ["CELERY_RABBITMQ_VHOST"]}'